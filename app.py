@@ -1,6 +1,7 @@
 import streamlit as st
+import openai
 from openai import OpenAI
-from PIL import Image
+from PIL import Image, features
 import requests
 from io import BytesIO
 import datetime
@@ -13,14 +14,114 @@ import uuid
 import os
 import re
 from urllib.parse import urlencode, quote
-import gc
+import threading
+import bisect
+import sys
+import types
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import sqlite3
+import hashlib
+import tempfile
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from streamlit.errors import StreamlitAPIException, StreamlitSecretNotFoundError
 
-# 為免費方案設定限制
-MAX_HISTORY_ITEMS = 15
-MAX_FAVORITE_ITEMS = 30
+# 為免費方案設定限制 (歷史與收藏保存在本地 SQLite，不再佔用會話記憶體，因此不設上限)
 MAX_BATCH_SIZE = 4
 
+# 並行生成設定 (Pollinations 不支持批量，需在應用層並行請求)
+GENERATION_POOL_WORKERS = 16  # 全進程共享的工作線程數
+UPSTREAM_REQUEST_TIMEOUT = 120  # 單次上游請求的超時
+BATCH_DEADLINE_SECONDS = 150  # 整批生成的總時限，逾時後取消剩餘請求
+HTTP_POOL_MAXSIZE = GENERATION_POOL_WORKERS  # 每個存檔保留的 keep-alive 連線數
+
+# 圖像以檔案形式保存在本地磁碟，會話中只保留 SHA-256 引用
+IMAGE_STORE_DIR = os.environ.get("FLUX_IMAGE_STORE_DIR", os.path.join(tempfile.gettempdir(), "flux_image_store"))
+IMAGE_STORE_MAX_BYTES = int(os.environ.get("FLUX_IMAGE_STORE_MAX_BYTES", 512 * 1024 * 1024))
+
+# 圖像下載以串流方式寫入磁碟暫存檔，並限制大小、類型與尺寸
+MAX_IMAGE_BYTES = int(os.environ.get("FLUX_MAX_IMAGE_BYTES", 25 * 1024 * 1024))
+MAX_IMAGE_DIMENSION = 4096
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# 縮圖與分頁：畫廊只傳送縮圖，原圖在展開或下載時才讀取
+THUMBNAIL_MAX_SIZE = 384
+THUMBNAIL_QUALITY = 80
+HISTORY_PAGE_SIZE = 5
+FAVORITES_PAGE_SIZE = 12
+
+# 歷史與收藏的持久化存儲，按用戶 (網址中的 uid 參數) 區分；預設放在用戶資料目錄，不放在會被清理的臨時目錄
+DATA_DIR = os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share"), "flux_ai")
+HISTORY_DB_PATH = os.environ.get("FLUX_HISTORY_DB", os.path.join(DATA_DIR, "history.sqlite3"))
+HISTORY_SEARCH_MIN_FTS_CHARS = 3  # trigram 索引只能匹配至少 3 個字符的詞，更短的詞改用 LIKE
+
+# 模型列表快取 (全進程共用)：過期後先返回舊列表，同時在背景刷新
+MODEL_REGISTRY_TTL_SECONDS = 600
+MODEL_REGISTRY_ERROR_RETRY_SECONDS = 60  # 刷新失敗後多久再試
+MODEL_DISCOVERY_TIMEOUT = 10
+
+# 指標：Prometheus 文本格式，可從本地端口 (/metrics) 或檔案導出，管理模式下在側邊欄顯示
+METRICS_PORT = int(os.environ.get("FLUX_METRICS_PORT", 0))  # 0 表示不啟動 HTTP 端點
+METRICS_HOST = os.environ.get("FLUX_METRICS_HOST", "127.0.0.1")
+METRICS_FILE = os.environ.get("FLUX_METRICS_FILE", "")
+METRICS_FILE_INTERVAL_SECONDS = 15
+METRICS_GAUGE_TTL_SECONDS = 900  # 超過此時間未更新的會話量表不再導出
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KiB ... 256 MiB
+METRIC_DEFINITIONS = {
+    "flux_script_run_seconds": ("histogram", "Streamlit 腳本單次執行耗時", LATENCY_BUCKETS),
+    "flux_upstream_attempt_seconds": ("histogram", "單次上游請求耗時 (含失敗)", LATENCY_BUCKETS),
+    "flux_upstream_errors_total": ("counter", "上游請求錯誤數", None),
+    "flux_generation_image_seconds": ("histogram", "單張圖像生成耗時 (含重試)", LATENCY_BUCKETS),
+    "flux_generation_batch_seconds": ("histogram", "一次生成請求的總耗時", LATENCY_BUCKETS),
+    "flux_image_bytes": ("histogram", "生成圖像的位元組數", BYTES_BUCKETS),
+    "flux_codec_seconds": ("histogram", "base64/PIL 編解碼耗時", LATENCY_BUCKETS),
+    "flux_model_discovery_seconds": ("histogram", "模型列表刷新耗時", LATENCY_BUCKETS),
+    "flux_render_image_seconds": ("histogram", "display_image_with_actions 單張渲染耗時", LATENCY_BUCKETS),
+    "flux_render_bytes": ("histogram", "單張渲染發送到瀏覽器的位元組數", BYTES_BUCKETS),
+    "flux_session_state_bytes": ("gauge", "每個會話 session_state 的估算大小", None),
+    "flux_process_rss_bytes": ("gauge", "進程常駐記憶體", None),
+    "flux_image_store_bytes": ("gauge", "本地圖像庫佔用的位元組數", None),
+    "flux_jobs": ("gauge", "背景生成任務數", None),
+    "flux_scheduler_wait_seconds": ("histogram", "上游請求在排程器中的等待時間", LATENCY_BUCKETS),
+    "flux_scheduler_queue_depth": ("gauge", "排程器中等待的上游請求數", None),
+    "flux_pool_lookups_total": ("counter", "連線池查找次數", None),
+    "flux_generation_cache_lookups_total": ("counter", "生成快取查找次數", None),
+}
+
+# 生成結果快取 (僅固定種子的請求可重現，才會被快取)
+GENERATION_CACHE_TTL_SECONDS = 3600
+GENERATION_CACHE_MAX_ENTRIES = 256
+
+# 重試與熔斷設定：指數退避 + 抖動，重試預算按提供商計算 (每個請求存入 budget_ratio 個重試令牌)
+RETRY_POLICIES = {
+    "Pollinations.ai": {"max_attempts": 3, "base_delay": 1.0, "max_delay": 20.0, "budget_ratio": 0.2, "budget_max": 10.0},
+    "default": {"max_attempts": 3, "base_delay": 2.0, "max_delay": 30.0, "budget_ratio": 0.1, "budget_max": 5.0},
+}
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+CIRCUIT_FAILURE_THRESHOLD = 5  # 連續失敗次數達到後熔斷
+CIRCUIT_RESET_SECONDS = 30  # 熔斷後等待多久放行一個試探請求
+
+# 上游排程：每個存檔一個令牌桶 + 並行上限，跨會話共用；單張的互動請求優先於批量請求
+# 存檔可用 'rate_limit_per_minute'、'burst' 與 'max_concurrency' 覆蓋提供商預設值
+PROVIDER_RATE_LIMITS = {
+    "Pollinations.ai": {"rate_limit_per_minute": 60, "burst": 4, "max_concurrency": 4},
+    "default": {"rate_limit_per_minute": 120, "burst": 8, "max_concurrency": 8},
+}
+SCHEDULER_OVERRIDE_KEYS = ("rate_limit_per_minute", "burst", "max_concurrency")
+PRIORITY_INTERACTIVE, PRIORITY_BATCH = 0, 1
+SCHEDULER_AGING_SECONDS = 30  # 等待每滿此秒數，優先級提升一級，避免批量請求餓死
+SCHEDULER_MAX_WAIT_SECONDS = BATCH_DEADLINE_SECONDS  # 沒有批次時限時的最長排隊時間
+
+# 背景生成任務：提交後立即返回，腳本線程不再被生成阻塞
+JOB_POOL_WORKERS = 4  # 全進程同時執行的生成任務數
+MAX_ACTIVE_JOBS_PER_USER = 2  # 每個用戶排隊 + 執行中的任務上限
+JOB_RETENTION_SECONDS = 3600  # 已結束的任務保留多久
+JOB_POLL_SECONDS = 1.5  # 有任務進行中時刷新任務面板的間隔
+
 # 圖像尺寸預設
 IMAGE_SIZES = {
     "自定義...": "Custom", "1024x1024": "正方形 (1:1)", "1080x1080": "IG 貼文 (1:1)",
@@ -81,71 +182,1004 @@ def init_session_state():
         st.session_state.api_profiles = base_profiles.copy() if base_profiles else {"預設 Pollinations": {'provider': 'Pollinations.ai', 'api_key': '', 'base_url': 'https://image.pollinations.ai', 'validated': True, 'pollinations_auth_mode': '免費', 'pollinations_token': '', 'pollinations_referrer': ''}}
     if 'active_profile_name' not in st.session_state or st.session_state.active_profile_name not in st.session_state.api_profiles:
         st.session_state.active_profile_name = list(st.session_state.api_profiles.keys())[0] if st.session_state.api_profiles else ""
-    defaults = {'generation_history': [], 'favorite_images': [], 'discovered_models': {}}
+    defaults = {'job_notices': [], 'expanded_images': set()}
     for key, value in defaults.items():
         if key not in st.session_state: st.session_state[key] = value
+    if 'user_id' not in st.session_state:
+        # uid 保存在網址中，重新打開同一網址即可找回歷史與收藏
+        uid = st.query_params.get("uid", "")
+        if not re.fullmatch(r"[0-9a-f-]{36}", uid): uid = str(uuid.uuid4()); st.query_params["uid"] = uid
+        st.session_state.user_id = uid
 
 def get_active_config(): return st.session_state.api_profiles.get(st.session_state.active_profile_name, {})
 
-def auto_discover_models(client, provider, base_url) -> Dict[str, Dict]:
-    discovered = {}
+def get_profile_key(cfg: Dict) -> Tuple:
+    """只取該提供商實際使用的憑證欄位，缺省欄位與空值視為相同，避免同一存檔得到不同的鍵。"""
+    if cfg.get('provider') == "Pollinations.ai":
+        auth_mode = cfg.get('pollinations_auth_mode') or '免費'
+        fields = (auth_mode, cfg.get('pollinations_token') if auth_mode == '令牌' else '', cfg.get('pollinations_referrer') if auth_mode == '域名' else '')
+    else: fields = (cfg.get('api_key'),)
+    credentials = "\n".join(str(field or '') for field in fields)
+    return (cfg.get('provider'), cfg.get('base_url'), hashlib.sha256(credentials.encode()).hexdigest()[:16])
+
+class MetricsRegistry:
+    """進程內的計數器、直方圖與量表，按 METRIC_DEFINITIONS 聲明，以 Prometheus 文本格式導出。"""
+    def __init__(self, definitions: Dict):
+        self.definitions = definitions
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, any] = {}  # (名稱, 標籤) -> 計數/量表值 或 直方圖 [各桶計數, 總和, 次數]
+        self._updated_at: Dict[Tuple, float] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict) -> Tuple: return (name, tuple(sorted((k, "" if v is None else str(v)) for k, v in labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock: self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock: self._values[key], self._updated_at[key] = value, time.monotonic()
+
+    def observe(self, name: str, value: float, **labels):
+        buckets, key = self.definitions[name][2], self._key(name, labels)
+        with self._lock:
+            histogram = self._values.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets): histogram[0][index] += 1
+            histogram[1] += value; histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """計時一段代碼；可在區塊內修改 labels (如 outcome)，退出時按最終標籤記錄。"""
+        start = time.perf_counter()
+        try: yield labels
+        finally: self.observe(name, time.perf_counter() - start, **labels)
+
+    def _snapshot(self) -> List[Tuple]:
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k, t in self._updated_at.items() if now - t > METRICS_GAUGE_TTL_SECONDS]: self._values.pop(key, None); self._updated_at.pop(key, None)
+            return sorted((name, labels, value if not isinstance(value, list) else [list(value[0]), value[1], value[2]]) for (name, labels), value in self._values.items())
+
+    def render(self) -> str:
+        def fmt(labels) -> str: return "{" + ",".join(f'{k}="{v.replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in labels) + "}" if labels else ""
+        lines, declared = [], set()
+        for name, labels, value in self._snapshot():
+            kind, help_text, buckets = self.definitions[name]
+            if name not in declared: lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]; declared.add(name)
+            if kind != "histogram": lines.append(f"{name}{fmt(labels)} {value}"); continue
+            cumulative = 0
+            for bound, count in zip(buckets, value[0]):
+                cumulative += count
+                lines.append(f"{name}_bucket{fmt(labels + (('le', repr(float(bound))),))} {cumulative}")
+            lines += [f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {value[2]}", f"{name}_sum{fmt(labels)} {value[1]}", f"{name}_count{fmt(labels)} {value[2]}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[Dict]:
+        """管理面板用的摘要：直方圖顯示次數、平均值與估算 p95。"""
+        rows = []
+        for name, labels, value in self._snapshot():
+            row = {"指標": name, "標籤": ", ".join(f"{k}={v}" for k, v in labels)}
+            if isinstance(value, list):
+                buckets, counts, total, count = self.definitions[name][2], value[0], value[1], value[2]
+                cumulative, p95 = 0, float("inf")
+                for bound, c in zip(buckets, counts):
+                    cumulative += c
+                    if cumulative >= 0.95 * count: p95 = bound; break
+                row.update({"次數": count, "平均": total / count if count else 0.0, "p95≤": p95})
+            else: row.update({"值": value})
+            rows.append(row)
+        return rows
+
+@st.cache_resource
+def get_metrics() -> MetricsRegistry:
+    return MetricsRegistry(METRIC_DEFINITIONS)
+
+def estimate_size(obj, _seen=None) -> int:
+    """粗略估算對象的記憶體佔用 (遞歸容器，不追蹤共享引用)。"""
+    _seen = set() if _seen is None else _seen
+    if id(obj) in _seen: return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, dict): size += sum(estimate_size(k, _seen) + estimate_size(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)): size += sum(estimate_size(item, _seen) for item in obj)
+    return size
+
+def process_rss_bytes() -> int:
     try:
-        if provider == "Pollinations.ai":
-            response = requests.get(f"{base_url}/models", timeout=10)
-            if response.ok:
-                models = response.json()
-                for model_name in models: discovered[model_name] = {"name": model_name.replace('-', ' ').title(), "icon": "🌸"}
-            else: st.warning(f"無法從 Pollinations 獲取模型列表: HTTP {response.status_code}")
-        elif client:
-            models = client.models.list().data
-            for model in models:
-                if 'flux' in model.id.lower() or 'kontext' in model.id.lower():
-                    icon = "⚡" if 'flux' in model.id.lower() else "🧠"
-                    discovered[model.id] = {"name": model.id.replace('-', ' ').replace('_', ' ').title(), "icon": icon}
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError): return 0
+
+def collect_runtime_metrics():
+    metrics = get_metrics()
+    metrics.set("flux_process_rss_bytes", process_rss_bytes())
+    metrics.set("flux_image_store_bytes", get_image_store().total_bytes)
+    jobs = get_job_manager().all_jobs()
+    for status in ("queued", "running"): metrics.set("flux_jobs", sum(1 for job in jobs if job.status == status), status=status)
+    pool_stats, cache_stats = get_connection_pool().stats(), get_generation_cache().stats()
+    for result in ("hits", "misses"): metrics.set("flux_pool_lookups_total", pool_stats[result], result=result)
+    for result in ("hits", "misses", "shared"): metrics.set("flux_generation_cache_lookups_total", cache_stats[result], result=result)
+    for (provider, base_url, _), status in get_request_scheduler().all_status().items(): metrics.set("flux_scheduler_queue_depth", status["waiting"], provider=provider, base_url=base_url)
+
+def render_metrics() -> str:
+    collect_runtime_metrics()
+    return get_metrics().render()
+
+# 導出器的狀態放在 sys.modules 中：streamlit 每次執行都重新載入本腳本的全局變量，「清除快取」也會清空 cache_resource，
+# 兩者都不能保存已綁定的端口，否則會重複綁定而拋出 Address already in use
+_metrics_exporters = sys.modules.setdefault("flux_metrics_exporters", types.ModuleType("flux_metrics_exporters"))
+if not hasattr(_metrics_exporters, "lock"): _metrics_exporters.lock, _metrics_exporters.started, _metrics_exporters.errors = threading.Lock(), None, {}
+
+def start_metrics_exporters() -> Tuple[Dict, Dict]:
+    """按環境變量啟動一次 /metrics 端點與定期寫檔線程，全進程共用；返回 (已啟動的導出目標, 啟動錯誤)。"""
+    with _metrics_exporters.lock:
+        if _metrics_exporters.started is None: _metrics_exporters.started = _start_metrics_exporters(_metrics_exporters.errors)
+        return _metrics_exporters.started, _metrics_exporters.errors
+
+def _start_metrics_exporters(errors: Dict) -> Dict:
+    started = {}
+    if METRICS_PORT:
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics": self.send_error(404); return
+                body = render_metrics().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        try:
+            server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+            threading.Thread(target=server.serve_forever, name="flux-metrics-http", daemon=True).start()
+            _metrics_exporters.http_server = server
+            started["http"] = f"http://{METRICS_HOST}:{server.server_port}/metrics"
+        except OSError as e: errors["http"] = f"無法在 {METRICS_HOST}:{METRICS_PORT} 開放 /metrics: {e}"
+    if METRICS_FILE:
+        def write_loop():
+            while True:
+                tmp_path = f"{METRICS_FILE}.tmp"
+                try:
+                    with open(tmp_path, "w", encoding="utf-8") as f: f.write(render_metrics())
+                    os.replace(tmp_path, METRICS_FILE)
+                except OSError: pass  # 目錄暫時不可寫時下一輪再試
+                time.sleep(METRICS_FILE_INTERVAL_SECONDS)
+        threading.Thread(target=write_loop, name="flux-metrics-file", daemon=True).start()
+        started["file"] = METRICS_FILE
+    return started
+
+def is_admin_mode() -> bool:
+    if os.environ.get("FLUX_ADMIN_MODE") == "1": return True
+    try: return bool(st.secrets.get("admin_mode", False))
+    except StreamlitSecretNotFoundError: return False
+
+def show_metrics_panel():
+    with st.expander("📈 運行指標 (管理)"):
+        exporters, errors = start_metrics_exporters()  # main() 已啟動，這裡只取回地址
+        if exporters: st.caption(" · ".join(f"{kind}: {target}" for kind, target in exporters.items()))
+        for error in errors.values(): st.warning(f"⚠️ {error}")
+        text = render_metrics()
+        st.dataframe(get_metrics().summary(), use_container_width=True, hide_index=True)
+        st.download_button("📥 導出 Prometheus 文本", text, "flux_metrics.prom", "text/plain", use_container_width=True)
+
+class ConnectionPool:
+    """按存檔 (提供商, 端點, 憑證) 保存 keep-alive 的 HTTP 會話與 OpenAI 客戶端，跨重跑與會話共用。"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: Dict[Tuple, requests.Session] = {}
+        self._clients: Dict[Tuple, OpenAI] = {}
+        self.hits, self.misses = 0, 0
+
+    def _lookup(self, cache: Dict, key: Tuple, factory):
+        with self._lock:
+            if key in cache: self.hits += 1; return cache[key]
+            self.misses += 1
+            cache[key] = factory()
+            return cache[key]
+
+    def http_session(self, cfg: Dict) -> requests.Session:
+        def factory():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("http://", adapter); session.mount("https://", adapter)
+            return session
+        return self._lookup(self._sessions, get_profile_key(cfg), factory)
+
+    def openai_client(self, cfg: Dict) -> OpenAI:
+        # 重試由 call_with_resilience 統一處理，關閉 SDK 自帶的重試以免疊加
+        return self._lookup(self._clients, get_profile_key(cfg), lambda: OpenAI(api_key=cfg.get('api_key'), base_url=cfg.get('base_url'), max_retries=0, timeout=UPSTREAM_REQUEST_TIMEOUT))
+
+    def invalidate(self, cfg: Dict):
+        """只從池中移除，不關閉：其他會話的任務可能仍持有同一個客戶端，待最後一個引用釋放後由垃圾回收關閉連線。"""
+        key = get_profile_key(cfg)
+        with self._lock: self._sessions.pop(key, None), self._clients.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock: return {"hits": self.hits, "misses": self.misses, "sessions": len(self._sessions), "clients": len(self._clients)}
+
+@st.cache_resource
+def get_connection_pool() -> ConnectionPool:
+    return ConnectionPool()
+
+class ImageStore:
+    """以原始位元組 SHA-256 為鍵的磁碟圖像庫。超出容量時按 LRU 淘汰，仍被引用 (收藏) 的圖像與剛寫入的圖像不會被淘汰。
+    容量計算包含縮圖。"""
+    def __init__(self, root: str, max_bytes: int):
+        self.root, self.max_bytes = root, max_bytes
+        self.thumb_root = os.path.join(root, "thumbs")
+        os.makedirs(self.thumb_root, exist_ok=True)
+        self.thumb_format, self.thumb_mime = ("WEBP", "image/webp") if features.check("webp") else ("JPEG", "image/jpeg")
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # digest -> 原圖 + 縮圖位元組數，按最近使用排序
+        self._refcounts: Dict[str, int] = {}
+        self.total_bytes = 0
+        for entry in os.scandir(root):
+            if entry.is_file() and entry.name.endswith((".tmp", ".part")): os.remove(entry.path)  # 上次中斷的寫入
+        existing = [entry for entry in os.scandir(root) if entry.is_file() and len(entry.name) == 64]
+        for entry in sorted(existing, key=lambda e: e.stat().st_mtime):
+            self._entries[entry.name] = entry.stat().st_size
+            self.total_bytes += entry.stat().st_size
+        for entry in os.scandir(self.thumb_root):
+            digest = entry.name.split(".")[0]
+            if digest in self._entries and entry.path == self.thumb_path(digest):
+                self._entries[digest] += entry.stat().st_size
+                self.total_bytes += entry.stat().st_size
+            elif entry.is_file(): os.remove(entry.path)  # 原圖已不存在、格式已變更或中斷寫入的縮圖
+
+    def path(self, digest: str) -> str: return os.path.join(self.root, digest)
+
+    def thumb_path(self, digest: str) -> str: return os.path.join(self.thumb_root, f"{digest}.{self.thumb_format.lower()}")
+
+    def read_thumbnail(self, digest: str):
+        """返回縮圖位元組；首次請求時從原圖縮放一次並寫入磁碟，之後直接讀取。讀取縮圖同樣更新 LRU 順序。"""
+        with self._lock:
+            if digest not in self._entries: return None
+            self._entries.move_to_end(digest)
+        try:
+            with open(self.thumb_path(digest), "rb") as f: return f.read()
+        except FileNotFoundError: pass
+        data = self.read(digest)
+        if data is None: return None
+        with get_metrics().timer("flux_codec_seconds", op="thumbnail"):
+            image = Image.open(BytesIO(data))
+            image.draft("RGB", (THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+            image.thumbnail((THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+            if image.mode not in ("RGB", "RGBA") or self.thumb_format == "JPEG": image = image.convert("RGB")
+            buffer = BytesIO()
+            image.save(buffer, self.thumb_format, quality=THUMBNAIL_QUALITY)
+        fd, tmp_path = tempfile.mkstemp(dir=self.thumb_root, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f: f.write(buffer.getvalue())
+        with self._lock:
+            if digest not in self._entries or os.path.exists(self.thumb_path(digest)): os.remove(tmp_path)  # 原圖已被淘汰或其他線程已寫入
+            else:
+                os.replace(tmp_path, self.thumb_path(digest))
+                self._entries[digest] += buffer.tell()
+                self.total_bytes += buffer.tell()
+                self._evict_locked(keep=digest)
+        return buffer.getvalue()
+
+    def put(self, data: bytes) -> str:
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f: f.write(data)
+        return self.put_file(tmp_path, hashlib.sha256(data).hexdigest(), len(data))
+
+    def temp_file(self) -> Tuple[int, str]:
+        """在圖像庫目錄下建立暫存檔 (與正式檔案同一檔案系統，可原子改名)。"""
+        return tempfile.mkstemp(dir=self.root, suffix=".part")
+
+    def put_file(self, tmp_path: str, digest: str, size: int) -> str:
+        """把已寫完的暫存檔收入圖像庫；內容已存在時直接刪除暫存檔。"""
+        with self._lock:
+            if digest in self._entries and os.path.exists(self.path(digest)): os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, self.path(digest))
+                if digest not in self._entries: self._entries[digest], self.total_bytes = size, self.total_bytes + size
+            self._entries.move_to_end(digest)
+            self._evict_locked(keep=digest)
+        return digest
+
+    def read(self, digest: str):
+        with self._lock:
+            if digest not in self._entries: return None
+            self._entries.move_to_end(digest)
+        try:
+            with open(self.path(digest), "rb") as f: return f.read()
+        except FileNotFoundError:
+            with self._lock:
+                if digest in self._entries: self._remove_locked(digest)
+            return None
+
+    def contains(self, digest: str) -> bool:
+        with self._lock: return digest in self._entries
+
+    def retain(self, digest: str):
+        with self._lock: self._refcounts[digest] = self._refcounts.get(digest, 0) + 1
+
+    def release(self, digest: str):
+        with self._lock:
+            if self._refcounts.get(digest, 0) <= 1: self._refcounts.pop(digest, None)
+            else: self._refcounts[digest] -= 1
+            self._evict_locked()
+
+    def evict(self):
+        with self._lock: self._evict_locked()
+
+    def _evict_locked(self, keep: str = None):
+        """keep 為剛寫入的圖像：即使被引用的圖像已佔滿容量也保留它，返回的引用才一定可讀。"""
+        for digest in list(self._entries):
+            if self.total_bytes <= self.max_bytes: break
+            if digest == keep or self._refcounts.get(digest): continue
+            self._remove_locked(digest)
+
+    def _remove_locked(self, digest: str):
+        self.total_bytes -= self._entries.pop(digest)
+        for path in (self.path(digest), self.thumb_path(digest)):
+            try: os.remove(path)
+            except FileNotFoundError: pass
+
+@st.cache_resource
+def get_image_store() -> ImageStore:
+    store = ImageStore(IMAGE_STORE_DIR, IMAGE_STORE_MAX_BYTES)
+    for image_ref in get_history_db().favorite_refs(): store.retain(image_ref)
+    store.evict()
+    return store
+
+class HistoryDB:
+    """SQLite 持久化的生成歷史與收藏。按用戶、時間、模型建立索引，提示詞以 FTS5 trigram 索引做子字串搜索 (支持中文)，分頁使用 (時間, id) 游標。"""
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS history (id TEXT PRIMARY KEY, user_id TEXT NOT NULL, created_at REAL NOT NULL, model TEXT, prompt TEXT, negative_prompt TEXT, images TEXT, metadata TEXT);
+                CREATE INDEX IF NOT EXISTS idx_history_user_time ON history (user_id, created_at DESC, id DESC);
+                CREATE INDEX IF NOT EXISTS idx_history_user_model ON history (user_id, model, created_at DESC);
+                CREATE TABLE IF NOT EXISTS favorites (user_id TEXT NOT NULL, image_id TEXT NOT NULL, image_ref TEXT NOT NULL, history_id TEXT, created_at REAL NOT NULL, PRIMARY KEY (user_id, image_id));
+                CREATE INDEX IF NOT EXISTS idx_favorites_user_time ON favorites (user_id, created_at DESC, image_id DESC);
+            """)
+            try:
+                exists = self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'history_prompt_fts'").fetchone()
+                self._conn.executescript("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS history_prompt_fts USING fts5(prompt, content='history', content_rowid='rowid', tokenize='trigram');
+                    CREATE TRIGGER IF NOT EXISTS history_prompt_fts_insert AFTER INSERT ON history BEGIN INSERT INTO history_prompt_fts (rowid, prompt) VALUES (new.rowid, new.prompt); END;
+                    CREATE TRIGGER IF NOT EXISTS history_prompt_fts_delete AFTER DELETE ON history BEGIN INSERT INTO history_prompt_fts (history_prompt_fts, rowid, prompt) VALUES ('delete', old.rowid, old.prompt); END;
+                    DROP TRIGGER IF EXISTS history_fts_insert;
+                    DROP TRIGGER IF EXISTS history_fts_delete;
+                    DROP TABLE IF EXISTS history_fts;
+                """)  # 舊版以 unicode61 分詞 (不切分中文) 並包含負向提示詞的索引
+                if not exists: self._conn.execute("INSERT INTO history_prompt_fts (history_prompt_fts) VALUES ('rebuild')")
+                self.has_fts = True
+            except sqlite3.OperationalError: self.has_fts = False  # SQLite 未編譯 FTS5 或版本低於 3.34 (無 trigram) 時退回 LIKE 搜索
+
+    def _query(self, sql: str, args=()) -> List[sqlite3.Row]:
+        with self._lock: return self._conn.execute(sql, args).fetchall()
+
+    def _write(self, sql: str, args=()) -> int:
+        with self._lock, self._conn: return self._conn.execute(sql, args).rowcount
+
+    @staticmethod
+    def _history_item(row) -> Dict:
+        return {"id": row["id"], "timestamp": datetime.datetime.fromtimestamp(row["created_at"]), "prompt": row["prompt"], "negative_prompt": row["negative_prompt"], "model": row["model"], "images": json.loads(row["images"]), "metadata": json.loads(row["metadata"] or "{}")}
+
+    def add_history(self, user_id: str, prompt: str, negative_prompt: str, model: str, images: List[str], metadata: Dict) -> str:
+        history_id = str(uuid.uuid4())
+        self._write("INSERT INTO history (id, user_id, created_at, model, prompt, negative_prompt, images, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (history_id, user_id, time.time(), model, prompt, negative_prompt, json.dumps(images), json.dumps(metadata, ensure_ascii=False)))
+        return history_id
+
+    def get_history(self, user_id: str, history_id: str):
+        rows = self._query("SELECT * FROM history WHERE id = ? AND user_id = ?", (history_id, user_id))
+        return self._history_item(rows[0]) if rows else None
+
+    def history_page(self, user_id: str, limit: int, cursor: Tuple = None, search: str = "", model: str = None) -> Tuple[List[Dict], Tuple]:
+        """返回一頁歷史 (新到舊) 與下一頁游標；沒有下一頁時游標為 None。"""
+        where, args = ["h.user_id = ?"], [user_id]
+        if cursor: where.append("(h.created_at, h.id) < (?, ?)"); args.extend(cursor)
+        if model: where.append("h.model = ?"); args.append(model)
+        # 每個詞都須是提示詞的子字串 (不分大小寫)；FTS 與 LIKE 兩條路徑語義相同
+        terms = search.split()
+        fts_terms = [term for term in terms if self.has_fts and len(term) >= HISTORY_SEARCH_MIN_FTS_CHARS]
+        if fts_terms:
+            where.append("h.rowid IN (SELECT rowid FROM history_prompt_fts WHERE history_prompt_fts MATCH ?)")
+            args.append(" ".join('"' + term.replace('"', '""') + '"' for term in fts_terms))
+        for term in terms:
+            if term in fts_terms: continue
+            where.append("h.prompt LIKE ? ESCAPE '\\'")
+            args.append("%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        rows = self._query(f"SELECT h.* FROM history h WHERE {' AND '.join(where)} ORDER BY h.created_at DESC, h.id DESC LIMIT ?", (*args, limit + 1))
+        items = [self._history_item(row) for row in rows[:limit]]
+        return items, ((rows[limit - 1]["created_at"], rows[limit - 1]["id"]) if len(rows) > limit else None)
+
+    def history_models(self, user_id: str) -> List[str]:
+        return [row["model"] for row in self._query("SELECT DISTINCT model FROM history WHERE user_id = ? ORDER BY model", (user_id,))]
+
+    def count_history(self, user_id: str) -> int:
+        return self._query("SELECT COUNT(*) FROM history WHERE user_id = ?", (user_id,))[0][0]
+
+    def add_favorite(self, user_id: str, image_id: str, image_ref: str, history_id: str) -> bool:
+        return self._write("INSERT OR IGNORE INTO favorites (user_id, image_id, image_ref, history_id, created_at) VALUES (?, ?, ?, ?, ?)", (user_id, image_id, image_ref, history_id, time.time())) > 0
+
+    def remove_favorite(self, user_id: str, image_id: str) -> bool:
+        return self._write("DELETE FROM favorites WHERE user_id = ? AND image_id = ?", (user_id, image_id)) > 0
+
+    def favorite_ids(self, user_id: str) -> set:
+        return {row["image_id"] for row in self._query("SELECT image_id FROM favorites WHERE user_id = ?", (user_id,))}
+
+    def favorite_refs(self) -> List[str]:
+        return [row["image_ref"] for row in self._query("SELECT image_ref FROM favorites")]
+
+    def count_favorites(self, user_id: str) -> int:
+        return self._query("SELECT COUNT(*) FROM favorites WHERE user_id = ?", (user_id,))[0][0]
+
+    def favorites_page(self, user_id: str, limit: int, cursor: Tuple = None) -> Tuple[List[Dict], Tuple]:
+        where, args = ["f.user_id = ?"], [user_id]
+        if cursor: where.append("(f.created_at, f.image_id) < (?, ?)"); args.extend(cursor)
+        rows = self._query(f"SELECT f.image_id, f.image_ref, f.created_at AS fav_created_at, h.* FROM favorites f LEFT JOIN history h ON h.id = f.history_id WHERE {' AND '.join(where)} ORDER BY f.created_at DESC, f.image_id DESC LIMIT ?", (*args, limit + 1))
+        items = [{"id": row["image_id"], "image_ref": row["image_ref"], "timestamp": datetime.datetime.fromtimestamp(row["fav_created_at"]), "history_item": self._history_item(row) if row["id"] else {"prompt": "", "negative_prompt": "", "model": ""}} for row in rows[:limit]]
+        return items, ((rows[limit - 1]["fav_created_at"], rows[limit - 1]["image_id"]) if len(rows) > limit else None)
+
+@st.cache_resource
+def get_history_db() -> HistoryDB:
+    return HistoryDB(HISTORY_DB_PATH)
+
+def fetch_models(client, provider: str, base_url: str, etag: str = None) -> Tuple[Dict[str, Dict], str, bool]:
+    """從端點獲取模型列表，返回 (模型, ETag, 是否未變更)。Pollinations 支持 If-None-Match 條件請求。"""
+    discovered = {}
+    if provider == "Pollinations.ai":
+        response = get_connection_pool().http_session({'provider': provider, 'base_url': base_url}).get(f"{base_url}/models", headers={"If-None-Match": etag} if etag else {}, timeout=MODEL_DISCOVERY_TIMEOUT)
+        if response.status_code == 304: return {}, etag, True
+        if not response.ok: raise UpstreamError(f"無法從 Pollinations 獲取模型列表: HTTP {response.status_code}", response.status_code)
+        for model in response.json():
+            model_name = model.get('name') if isinstance(model, dict) else model
+            if model_name: discovered[model_name] = {"name": model_name.replace('-', ' ').title(), "icon": "🌸"}
+        return discovered, response.headers.get("ETag"), False
+    for model in client.models.list().data:
+        if 'flux' in model.id.lower() or 'kontext' in model.id.lower():
+            icon = "⚡" if 'flux' in model.id.lower() else "🧠"
+            discovered[model.id] = {"name": model.id.replace('-', ' ').replace('_', ' ').title(), "icon": icon}
+    return discovered, None, False
+
+class ModelRegistry:
+    """按 (提供商, 端點) 共用的模型列表快取。過期時先返回舊列表並在背景刷新 (stale-while-revalidate)，合併後的模型表按版本記憶。"""
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple, Dict] = {}  # key -> {"models", "etag", "fetched_at", "next_refresh", "version", "error"}
+        self._refreshing = set()
+        self._merged: Dict[Tuple, Tuple[int, Dict]] = {}
+
+    def _refresh(self, key: Tuple, client):
+        provider, base_url = key
+        with self._lock: entry = dict(self._entries.get(key, {"models": {}, "etag": None, "fetched_at": None, "version": 0}))
+        try:
+            with get_metrics().timer("flux_model_discovery_seconds", provider=provider, outcome="error") as labels:
+                models, etag, not_modified = fetch_models(client, provider, base_url, entry["etag"])
+                labels["outcome"] = "not_modified" if not_modified else "ok"
+            if not not_modified: entry.update(models=models, etag=etag, version=entry["version"] + 1)
+            entry.update(fetched_at=time.time(), next_refresh=time.monotonic() + self.ttl, error=None)
+        except Exception as e: entry.update(next_refresh=time.monotonic() + MODEL_REGISTRY_ERROR_RETRY_SECONDS, error=str(e))
+        finally:
+            with self._lock:
+                self._entries[key] = entry
+                self._refreshing.discard(key)
+        return entry
+
+    def refresh(self, provider: str, base_url: str, client) -> Dict:
+        """同步刷新 (手動「發現模型」)，失敗時拋出異常。"""
+        key = (provider, base_url)
+        with self._lock: self._refreshing.add(key)
+        entry = self._refresh(key, client)
+        if entry["error"]: raise UpstreamError(entry["error"])
+        return entry["models"]
+
+    def _entry(self, provider: str, base_url: str, client) -> Dict:
+        """返回當前條目 (刷新時整個替換，不會原地修改，因此其中的 models 與 version 一致)，過期時在背景刷新。"""
+        key = (provider, base_url)
+        with self._lock:
+            entry = self._entries.get(key)
+            stale = entry is None or time.monotonic() >= entry["next_refresh"]
+            can_fetch = provider == "Pollinations.ai" or client is not None
+            start = stale and can_fetch and key not in self._refreshing
+            if start: self._refreshing.add(key)
+        if start: get_generation_executor().submit(self._refresh, key, client)
+        return entry or {"models": {}, "version": 0}
+
+    def get(self, provider: str, base_url: str, client) -> Dict[str, Dict]:
+        return self._entry(provider, base_url, client)["models"]
+
+    def merged(self, provider: str, base_url: str, client) -> Dict[str, Dict]:
+        entry = self._entry(provider, base_url, client)
+        discovered, version, key = entry["models"], entry["version"], (provider, base_url)
+        with self._lock:
+            cached = self._merged.get(key)
+            if cached and cached[0] == version: return cached[1]
+            base = API_PROVIDERS['Pollinations.ai'].get('hardcoded_models', {}) if provider == 'Pollinations.ai' else BASE_FLUX_MODELS
+            merged = {**base, **discovered}
+            if not cached or cached[0] < version: self._merged[key] = (version, merged)  # 不讓較舊的快照覆蓋較新的
+            return merged
+
+    def info(self, provider: str, base_url: str) -> Dict:
+        with self._lock: return dict(self._entries.get((provider, base_url), {}))
+
+@st.cache_resource
+def get_model_registry() -> ModelRegistry:
+    return ModelRegistry(MODEL_REGISTRY_TTL_SECONDS)
+
+def auto_discover_models(client, provider, base_url) -> Dict[str, Dict]:
+    try: return get_model_registry().refresh(provider, base_url, client)
     except Exception as e: st.error(f"發現模型失敗: {e}")
-    return discovered
+    return {}
 
 def merge_models() -> Dict[str, Dict]:
-    provider = get_active_config().get('provider')
-    if provider == 'Pollinations.ai':
-        discovered = st.session_state.get('discovered_models', {})
-        hardcoded = API_PROVIDERS['Pollinations.ai'].get('hardcoded_models', {})
-        return {**hardcoded, **discovered}
-    else: return {**BASE_FLUX_MODELS, **st.session_state.get('discovered_models', {})}
-
-def validate_api_key(api_key: str, base_url: str, provider: str) -> Tuple[bool, str]:
-    if provider == "Pollinations.ai": return True, "Pollinations.ai 無需驗證"
-    try: OpenAI(api_key=api_key, base_url=base_url).models.list(); return True, "API 密鑰驗證成功"
-    except Exception as e: return False, f"API 驗證失敗: {e}"
-
-def generate_images_with_retry(client, **params) -> Tuple[bool, any]:
-    provider = get_active_config().get('provider')
-    n_images = params.get("n", 1)
+    cfg = get_active_config()
+    return get_model_registry().merged(cfg.get('provider'), cfg.get('base_url'), init_api_client())
 
-    if provider == "Pollinations.ai":
-        generated_images = []
-        for i in range(n_images):
+def validate_api_key(cfg: Dict) -> Tuple[bool, str]:
+    """以完整存檔驗證，驗證時建立的客戶端與存檔共用同一個連線池條目。"""
+    if cfg.get('provider') == "Pollinations.ai": return True, "Pollinations.ai 無需驗證"
+    try: get_connection_pool().openai_client(cfg).models.list(); return True, "API 密鑰驗證成功"
+    except Exception as e:
+        get_connection_pool().invalidate(cfg)
+        return False, f"API 驗證失敗: {e}"
+
+class UpstreamError(Exception):
+    def __init__(self, message: str, status: int = None, retry_after: float = None, retryable: bool = True):
+        super().__init__(message)
+        self.status, self.retry_after, self.retryable = status, retry_after, retryable
+
+class RequestCancelledError(UpstreamError):
+    """請求因取消或時限在上游給出結果前中止，不反映端點健康狀況。"""
+    def __init__(self, message: str):
+        super().__init__(message, retryable=False)
+
+class ImageRejectedError(UpstreamError):
+    """端點已正常回應，但圖像違反本地限制 (大小、尺寸、無法解碼)；不計入熔斷器失敗。"""
+    def __init__(self, message: str):
+        super().__init__(message, retryable=False)
+
+class CircuitOpenError(UpstreamError):
+    def __init__(self, retry_in: float):
+        super().__init__(f"端點暫時不可用 (熔斷中)，約 {retry_in:.0f} 秒後重試", retryable=False)
+
+def parse_retry_after(value) -> float:
+    if not value: return None
+    try: return max(0.0, float(value))
+    except ValueError: pass
+    try: return max(0.0, (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError): return None
+
+def classify_upstream_error(e: Exception) -> UpstreamError:
+    if isinstance(e, UpstreamError): return e
+    if isinstance(e, openai.APIStatusError):
+        return UpstreamError(str(e), e.status_code, parse_retry_after(e.response.headers.get("retry-after")), e.status_code in RETRYABLE_STATUS_CODES)
+    if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError, requests.Timeout, requests.ConnectionError, TimeoutError)): return UpstreamError(f"連線失敗或超時: {e}")
+    return UpstreamError(str(e), retryable=False)
+
+class CircuitBreaker:
+    """連續失敗達到閾值後熔斷，期間直接拒絕請求；冷卻後放行一個試探請求 (半開)，成功即恢復，失敗則重新熔斷。
+    試探請求被取消時調用 abandon_probe 交還名額，讓下一個請求接替試探。"""
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold, self.reset_seconds = failure_threshold, reset_seconds
+        self._lock = threading.Lock()
+        self.state, self.failures, self.opened_at = "closed", 0, 0.0
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "closed": return
+            retry_in = self.opened_at + self.reset_seconds - time.monotonic()
+            if self.state == "open" and retry_in <= 0: self.state = "half_open"; return
+            raise CircuitOpenError(max(retry_in, 0.0))
+
+    def record_success(self):
+        with self._lock: self.state, self.failures = "closed", 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold: self.state, self.opened_at = "open", time.monotonic()
+
+    def abandon_probe(self):
+        with self._lock:
+            if self.state == "half_open": self.state, self.opened_at = "open", time.monotonic() - self.reset_seconds
+
+    def is_open(self) -> bool:
+        """熔斷中或試探請求進行中時返回 True，此時新請求會被拒絕。"""
+        with self._lock: return self.state == "half_open" or (self.state == "open" and time.monotonic() < self.opened_at + self.reset_seconds)
+
+class RetryBudget:
+    """每個請求存入 ratio 個令牌，每次重試消耗一個，避免上游故障時重試放大流量。"""
+    def __init__(self, ratio: float, max_tokens: float):
+        self.ratio, self.max_tokens, self.tokens = ratio, max_tokens, max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock: self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1: return False
+            self.tokens -= 1
+            return True
+
+class ResilienceRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers: Dict[Tuple, CircuitBreaker] = {}
+        self._budgets: Dict[str, RetryBudget] = {}
+
+    def breaker(self, cfg: Dict) -> CircuitBreaker:
+        with self._lock: return self._breakers.setdefault(get_profile_key(cfg), CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS))
+
+    def budget(self, provider: str) -> RetryBudget:
+        policy = RETRY_POLICIES.get(provider, RETRY_POLICIES["default"])
+        with self._lock: return self._budgets.setdefault(provider, RetryBudget(policy["budget_ratio"], policy["budget_max"]))
+
+@st.cache_resource
+def get_resilience_registry() -> ResilienceRegistry:
+    return ResilienceRegistry()
+
+def call_with_resilience(cfg: Dict, fn, deadline: float = None, cancelled: threading.Event = None, model: str = None, priority: int = PRIORITY_BATCH, queue_tag: str = None):
+    """以指數退避 + 抖動重試上游調用，遵守 Retry-After、提供商重試預算、批次時限與存檔熔斷器。
+    每次嘗試都先向存檔的排程器取得名額，所有會話的上游請求因此共用同一份配額。"""
+    scheduler = get_request_scheduler().get(cfg)
+    provider, metrics = cfg.get('provider'), get_metrics()
+    policy = RETRY_POLICIES.get(provider, RETRY_POLICIES["default"])
+    registry = get_resilience_registry()
+    breaker, budget = registry.breaker(cfg), registry.budget(provider)
+    budget.deposit()
+    for attempt in range(1, policy["max_attempts"] + 1):
+        try:
+            if breaker.is_open(): breaker.before_call()  # 熔斷中直接失敗，不佔用排隊名額
+            with scheduler.slot(priority, deadline, cancelled, queue_tag):
+                breaker.before_call()
+                start = time.perf_counter()
+                try: return_value, error = fn(), None
+                except Exception as e: cause, error = e, classify_upstream_error(e)
+                if error is not None and error.status == 429: scheduler.throttle(error.retry_after, policy["max_delay"])
+        except CircuitOpenError:
+            metrics.inc("flux_upstream_errors_total", provider=provider, model=model, status="circuit_open")
+            raise
+        metrics.observe("flux_upstream_attempt_seconds", time.perf_counter() - start, provider=provider, outcome="ok" if error is None else "error")
+        if error is None:
+            breaker.record_success()
+            return return_value
+        metrics.inc("flux_upstream_errors_total", provider=provider, model=model, status=error.status or "error")
+        # 每個結束的請求都要讓熔斷器離開半開狀態：上游有 HTTP 回應的非重試錯誤與本地圖像限制視為端點可用
+        if isinstance(error, RequestCancelledError): breaker.abandon_probe()
+        elif error.retryable or (error.status is None and not isinstance(error, ImageRejectedError)): breaker.record_failure()
+        else: breaker.record_success()
+        if not error.retryable or attempt == policy["max_attempts"] or not budget.withdraw(): raise error from cause
+        # Retry-After 超過最長退避時間時直接失敗，不讓工作線程長時間空等
+        if error.retry_after is not None and error.retry_after > policy["max_delay"]: raise error from cause
+        delay = error.retry_after if error.retry_after is not None else random.uniform(0, min(policy["max_delay"], policy["base_delay"] * 2 ** (attempt - 1)))
+        if deadline is not None and time.monotonic() + delay >= deadline: raise error from cause
+        if cancelled is not None:
+            if cancelled.wait(delay): raise error from cause
+        else: time.sleep(delay)
+
+class ProfileScheduler:
+    """單個存檔的上游請求排程：令牌桶限速 + 並行上限 + 優先隊列 (同優先級先到先得)。"""
+    def __init__(self, rate_per_minute: float, burst: int, max_concurrency: int):
+        self.rate, self.burst, self.max_concurrency = max(rate_per_minute, 0.1) / 60.0, max(1, burst), max(1, max_concurrency)
+        self._cond = threading.Condition()
+        self._tokens, self._refilled_at, self._paused_until = float(self.burst), time.monotonic(), 0.0
+        self._active = 0
+        self._waiters: List[Dict] = []
+        self._seq = 0
+        self._service_seconds = None  # 單次上游請求耗時的指數移動平均，用於估算等待時間
+
+    def configure(self, rate_per_minute: float, burst: int, max_concurrency: int):
+        with self._cond:
+            rate, burst, max_concurrency = max(rate_per_minute, 0.1) / 60.0, max(1, burst), max(1, max_concurrency)
+            if (rate, burst, max_concurrency) == (self.rate, self.burst, self.max_concurrency): return
+            self._refill_locked(time.monotonic())
+            self.rate, self.burst, self.max_concurrency = rate, burst, max_concurrency
+            self._tokens = min(self._tokens, burst)
+            self._cond.notify_all()
+
+    def _refill_locked(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _ordered_locked(self, now: float) -> List[Dict]:
+        return sorted(self._waiters, key=lambda w: (w["priority"] - int((now - w["enqueued"]) // SCHEDULER_AGING_SECONDS), w["seq"]))
+
+    def acquire(self, priority: int, deadline: float = None, cancelled: threading.Event = None, tag: str = None):
+        start = time.monotonic()
+        deadline = deadline if deadline is not None else start + SCHEDULER_MAX_WAIT_SECONDS
+        with self._cond:
+            self._seq += 1
+            waiter = {"priority": priority, "seq": self._seq, "enqueued": start, "tag": tag}
+            self._waiters.append(waiter)
             try:
-                current_params = params.copy()
-                current_params["seed"] = random.randint(0, 1000000)
-                prompt = current_params.get("prompt", "")
-                if (neg_prompt := current_params.get("negative_prompt")): prompt += f" --no {neg_prompt}"
-                width, height = str(current_params.get("size", "1024x1024")).split('x')
-                api_params = {k: v for k, v in {"model": current_params.get("model"), "width": width, "height": height, "seed": current_params.get("seed"), "nologo": current_params.get("nologo"), "private": current_params.get("private"), "enhance": current_params.get("enhance"), "safe": current_params.get("safe")}.items() if v}
-                cfg = get_active_config()
-                headers = {}
-                auth_mode = cfg.get('pollinations_auth_mode', '免費')
-                if auth_mode == '令牌' and cfg.get('pollinations_token'): headers['Authorization'] = f"Bearer {cfg['pollinations_token']}"
-                elif auth_mode == '域名' and cfg.get('pollinations_referrer'): headers['Referer'] = cfg['pollinations_referrer']
-                response = requests.get(f"{cfg['base_url']}/prompt/{quote(prompt)}?{urlencode(api_params)}", headers=headers, timeout=120)
-                if response.ok:
-                    b64_json = base64.b64encode(response.content).decode()
-                    image_obj = type('Image', (object,), {'b64_json': b64_json})
-                    generated_images.append(image_obj)
-                else: st.warning(f"第 {i+1} 張圖片生成失敗: HTTP {response.status_code}")
+                while True:
+                    now = time.monotonic()
+                    if cancelled is not None and cancelled.is_set(): raise RequestCancelledError("請求已取消")
+                    if now >= deadline: raise RequestCancelledError("等待上游配額逾時")
+                    if self._paused_until >= deadline: raise RequestCancelledError("上游要求退讓的時間超出請求時限")  # 無需空等到時限
+                    self._refill_locked(now)
+                    if now >= self._paused_until and self._active < self.max_concurrency and self._tokens >= 1 and self._ordered_locked(now)[0] is waiter:
+                        self._tokens -= 1
+                        self._active += 1
+                        return now - start
+                    # 下一個令牌或暫停結束的時間；名額已滿時等 release 通知，並定期醒來檢查取消
+                    wake = max(self._paused_until - now, (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0)
+                    self._cond.wait(min(max(wake, 0.01), deadline - now, 0.5))
+            finally:
+                self._waiters.remove(waiter)
+                self._cond.notify_all()
+
+    def release(self, service_seconds: float):
+        with self._cond:
+            self._active -= 1
+            self._service_seconds = service_seconds if self._service_seconds is None else 0.8 * self._service_seconds + 0.2 * service_seconds
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority: int, deadline: float = None, cancelled: threading.Event = None, tag: str = None):
+        waited = self.acquire(priority, deadline, cancelled, tag)
+        get_metrics().observe("flux_scheduler_wait_seconds", waited, priority="interactive" if priority == PRIORITY_INTERACTIVE else "batch")
+        start = time.monotonic()
+        try: yield
+        finally: self.release(time.monotonic() - start)
+
+    def throttle(self, retry_after: float = None, max_pause: float = None):
+        """收到 429 時清空令牌並暫停放行，讓所有會話一起退讓，而不是各自重試造成風暴；暫停時間不超過 max_pause。"""
+        pause = retry_after if retry_after is not None else 1 / self.rate
+        with self._cond:
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, time.monotonic() + (min(pause, max_pause) if max_pause is not None else pause))
+            self._cond.notify_all()  # 讓等待者立即按新的暫停時間重新判斷時限
+
+    def _estimate_locked(self, ahead: int, now: float) -> float:
+        token_wait = max(0.0, ahead + 1 - self._tokens) / self.rate
+        slot_wait = max(0, ahead + 1 + self._active - self.max_concurrency) / self.max_concurrency * (self._service_seconds or 0.0)
+        return max(self._paused_until - now, 0.0) + max(token_wait, slot_wait)
+
+    def status(self, tag: str = None) -> Dict:
+        """返回排隊狀態；指定 tag 時附上該標籤最靠前的請求的位置 (前方請求數) 與預計等待秒數。"""
+        with self._cond:
+            now = time.monotonic()
+            self._refill_locked(now)
+            ordered = self._ordered_locked(now)
+            result = {"waiting": len(ordered), "active": self._active, "tokens": self._tokens, "max_concurrency": self.max_concurrency}
+            ahead = next((i for i, w in enumerate(ordered) if tag is not None and w["tag"] == tag), None)
+            if ahead is not None: result.update(position=ahead, eta=self._estimate_locked(ahead, now))
+            return result
+
+class RequestScheduler:
+    """全進程共用，按存檔 (相同端點與憑證) 建立 ProfileScheduler；限速參數取自提供商預設與存檔覆蓋值。"""
+    def __init__(self, limits: Dict[str, Dict]):
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._schedulers: Dict[Tuple, ProfileScheduler] = {}
+
+    def get(self, cfg: Dict) -> ProfileScheduler:
+        key = get_profile_key(cfg)
+        overrides = {k: cfg[k] for k in SCHEDULER_OVERRIDE_KEYS if cfg.get(k)}
+        limits = {**self.limits.get(cfg.get('provider'), self.limits["default"]), **overrides}
+        limits = (float(limits["rate_limit_per_minute"]), int(limits["burst"]), int(limits["max_concurrency"]))
+        with self._lock:
+            if created := key not in self._schedulers: self._schedulers[key] = ProfileScheduler(*limits)
+            scheduler = self._schedulers[key]
+        # 只有帶覆蓋值的存檔才重設限速 (修改後立即生效)；不帶覆蓋值的 cfg (如其他會話的舊副本) 不得把共用排程器改回預設值
+        if overrides and not created: scheduler.configure(*limits)
+        return scheduler
+
+    def find(self, tag: str) -> Dict:
+        """在所有存檔中查找標籤為 tag 的排隊請求，找不到時返回 None。"""
+        with self._lock: schedulers = list(self._schedulers.values())
+        for scheduler in schedulers:
+            if "position" in (status := scheduler.status(tag)): return status
+        return None
+
+    def all_status(self) -> Dict[Tuple, Dict]:
+        with self._lock: schedulers = dict(self._schedulers)
+        return {key: scheduler.status() for key, scheduler in schedulers.items()}
+
+@st.cache_resource
+def get_generation_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=GENERATION_POOL_WORKERS, thread_name_prefix="flux-gen")
+
+@st.cache_resource
+def get_request_scheduler() -> RequestScheduler:
+    return RequestScheduler(PROVIDER_RATE_LIMITS)
+
+def request_priority(n_images: int) -> int:
+    return PRIORITY_INTERACTIVE if n_images == 1 else PRIORITY_BATCH
+
+def build_pollinations_request(cfg: Dict, params: Dict) -> Tuple[str, Dict]:
+    prompt = params.get("prompt", "")
+    if (neg_prompt := params.get("negative_prompt")): prompt += f" --no {neg_prompt}"
+    width, height = str(params.get("size", "1024x1024")).split('x')
+    api_params = {k: v for k, v in {"model": params.get("model"), "width": width, "height": height, "seed": params.get("seed"), "nologo": params.get("nologo"), "private": params.get("private"), "enhance": params.get("enhance"), "safe": params.get("safe")}.items() if v}
+    headers = {}
+    auth_mode = cfg.get('pollinations_auth_mode', '免費')
+    if auth_mode == '令牌' and cfg.get('pollinations_token'): headers['Authorization'] = f"Bearer {cfg['pollinations_token']}"
+    elif auth_mode == '域名' and cfg.get('pollinations_referrer'): headers['Referer'] = cfg['pollinations_referrer']
+    return f"{cfg['base_url']}/prompt/{quote(prompt)}?{urlencode(api_params)}", headers
+
+def check_image_dimensions(source):
+    """只讀取圖像標頭檢查尺寸，不解碼像素。"""
+    try:
+        with get_metrics().timer("flux_codec_seconds", op="image_header"), Image.open(source) as image: width, height = image.size
+    except Exception as e: raise ImageRejectedError("無法識別的圖像數據") from e
+    if max(width, height) > MAX_IMAGE_DIMENSION: raise ImageRejectedError(f"圖像尺寸 {width}x{height} 超出上限 {MAX_IMAGE_DIMENSION}")
+
+def decode_b64_image(b64_json: str, provider: str) -> bytes:
+    metrics = get_metrics()
+    with metrics.timer("flux_codec_seconds", op="b64decode"): data = base64.b64decode(b64_json)
+    metrics.observe("flux_image_bytes", len(data), provider=provider)
+    return data
+
+def store_image_bytes(data: bytes) -> str:
+    if len(data) > MAX_IMAGE_BYTES: raise ImageRejectedError(f"圖像大小超出上限 {MAX_IMAGE_BYTES / (1024 * 1024):.1f} MB")
+    check_image_dimensions(BytesIO(data))
+    return get_image_store().put(data)
+
+def fetch_pollinations_image(cfg: Dict, params: Dict, timeout: float, deadline: float = None) -> str:
+    """以串流方式下載圖像到圖像庫暫存檔，邊下載邊計算 SHA-256，記憶體只保留一個分塊；返回圖像引用。"""
+    url, headers = build_pollinations_request(cfg, params)
+    with get_connection_pool().http_session(cfg).get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if not response.ok: raise UpstreamError(f"HTTP {response.status_code}", response.status_code, parse_retry_after(response.headers.get("Retry-After")), response.status_code in RETRYABLE_STATUS_CODES)
+        content_type = response.headers.get("Content-Type", "")
+        if not content_type.startswith("image/"): raise UpstreamError(f"返回的不是圖像 ({content_type or '未知類型'})", retryable=False)
+        if int(response.headers.get("Content-Length") or 0) > MAX_IMAGE_BYTES: raise ImageRejectedError(f"圖像大小超出上限 {MAX_IMAGE_BYTES / (1024 * 1024):.1f} MB")
+        store = get_image_store()
+        fd, tmp_path = store.temp_file()
+        try:
+            hasher, size = hashlib.sha256(), 0
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MAX_IMAGE_BYTES: raise ImageRejectedError(f"圖像大小超出上限 {MAX_IMAGE_BYTES / (1024 * 1024):.1f} MB")
+                    if deadline is not None and time.monotonic() > deadline: raise RequestCancelledError("已超出批次時限")
+                    hasher.update(chunk)
+                    f.write(chunk)
+            check_image_dimensions(tmp_path)
+            get_metrics().observe("flux_image_bytes", size, provider=cfg.get('provider'))
+            return store.put_file(tmp_path, hasher.hexdigest(), size)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+
+def generate_pollinations_batch(cfg: Dict, params: Dict, n_images: int, on_image=None, cancel_event: threading.Event = None, queue_tag: str = None) -> Tuple[List, List[str]]:
+    """並行生成一批圖像，按完成順序返回；超過總時限或被取消後，取消未完成的請求並返回已完成的部分結果。
+    並行數與速率由存檔的排程器控制 (見 call_with_resilience)。"""
+    deadline = time.monotonic() + BATCH_DEADLINE_SECONDS
+    cancelled = threading.Event()
+    priority = request_priority(n_images)
+
+    def worker(current_params: Dict) -> str:
+        def attempt() -> str:
+            remaining = deadline - time.monotonic()
+            if cancelled.is_set() or remaining <= 0: raise RequestCancelledError("已超出批次時限")
+            return fetch_pollinations_image(cfg, current_params, timeout=min(UPSTREAM_REQUEST_TIMEOUT, remaining), deadline=deadline)
+        with get_metrics().timer("flux_generation_image_seconds", provider=cfg.get('provider'), model=current_params.get("model"), outcome="error") as labels:
+            digest = call_with_resilience(cfg, attempt, deadline=deadline, cancelled=cancelled, model=current_params.get("model"), priority=priority, queue_tag=queue_tag)
+            labels["outcome"] = "ok"
+        return digest
+
+    executor = get_generation_executor()
+    seeds = [params["seed"] + i if params.get("seed") is not None else random.randint(0, 1000000) for i in range(n_images)]
+    futures = {executor.submit(worker, {**params, "seed": seed}): i for i, seed in enumerate(seeds)}
+    generated_images, errors, pending = [], [], set(futures)
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or (cancel_event is not None and cancel_event.is_set()): break
+        done, pending = wait(pending, timeout=min(remaining, 0.5), return_when=FIRST_COMPLETED)
+        for future in done:
+            i = futures[future]
+            try: image_obj = type('Image', (object,), {'digest': future.result()})
             except Exception as e:
-                st.warning(f"第 {i+1} 張圖片生成時出錯: {e}")
+                errors.append(f"第 {i+1} 張圖片生成失敗: {e}")
                 continue
+            generated_images.append(image_obj)
+            if on_image: on_image(i, image_obj)
+    if pending:
+        cancelled.set()
+        reason = "已取消" if cancel_event is not None and cancel_event.is_set() else f"超出 {BATCH_DEADLINE_SECONDS} 秒時限，已取消"
+        for future in pending:
+            future.cancel()
+            errors.append(f"第 {futures[future]+1} 張圖片{reason}")
+    return generated_images, errors
+
+class GenerationCache:
+    """以標準化請求為鍵的生成結果快取 (TTL + LRU)，並對同時進行的相同請求做單飛去重，跨會話共用一次上游調用。
+    不鎖定圖像庫中的圖像：圖像被淘汰後，查找時視為未命中。"""
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl, self.max_entries = ttl, max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()  # key -> (過期時間, 圖像引用)
+        self._inflight: Dict[str, Dict] = {}
+        self.hits, self.misses, self.shared = 0, 0, 0
+
+    @staticmethod
+    def make_key(cfg: Dict, params: Dict):
+        if params.get("seed") is None: return None
+        normalized = {"provider": cfg.get('provider'), "base_url": (cfg.get('base_url') or '').rstrip('/'), "model": params.get("model"), "prompt": (params.get("prompt") or '').strip(), "negative_prompt": (params.get("negative_prompt") or '').strip(), "size": str(params.get("size")), "n": int(params.get("n", 1)), "seed": int(params["seed"]), **{flag: bool(params.get(flag)) for flag in ("enhance", "private", "nologo", "safe")}}
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def _lookup_locked(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None: return None
+        expires_at, image_refs = entry
+        if expires_at < time.monotonic() or not all(get_image_store().contains(ref) for ref in image_refs):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return image_refs
+
+    def _store(self, key: str, image_refs: List[str]):
+        with self._lock:
+            now = time.monotonic()
+            for expired in [k for k, (expires_at, _) in self._entries.items() if expires_at < now]: del self._entries[expired]
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, image_refs)
+            while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+
+    def get_or_generate(self, key: str, n_images: int, generate, cancel_event: threading.Event = None, warn=None) -> Tuple[bool, any]:
+        """generate(warn) 只由領頭者執行，其警告會轉發給所有跟隨者。跟隨者的 cancel_event 被設定時立即放棄等待。
+        領頭者被取消時，其不完整的結果不會交給跟隨者；跟隨者重新競選領頭者並自行生成。"""
+        warn = warn or (lambda message: None)
+        while True:
+            with self._lock:
+                image_refs = self._lookup_locked(key)
+                if image_refs is not None:
+                    self.hits += 1
+                    return True, type('Response', (object,), {'data': [type('Image', (object,), {'digest': ref}) for ref in image_refs], 'cached': True})
+                flight = self._inflight.get(key)
+                is_leader = flight is None
+                if is_leader:
+                    self.misses += 1
+                    flight = self._inflight[key] = {"event": threading.Event(), "result": (False, "相同請求的生成未完成。"), "warnings": [], "cancelled": False}
+                else: self.shared += 1
+            if is_leader: break
+            give_up_at = time.monotonic() + BATCH_DEADLINE_SECONDS + 30
+            while not flight["event"].wait(timeout=0.5):
+                if cancel_event is not None and cancel_event.is_set(): return False, "已取消"
+                if time.monotonic() >= give_up_at: break
+            if flight["cancelled"]: continue
+            for message in flight["warnings"]: warn(message)
+            return flight["result"]
+
+        def forward(message: str):
+            flight["warnings"].append(message)
+            warn(message)
+        try:
+            flight["result"] = generate(forward)
+            success, result = flight["result"]
+            if success and len(result.data) == n_images: self._store(key, [img.digest for img in result.data])
+        except Exception as e: flight["result"] = (False, str(e))
+        finally:
+            flight["cancelled"] = cancel_event is not None and cancel_event.is_set()
+            with self._lock: self._inflight.pop(key, None)
+            flight["event"].set()
+        return flight["result"]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock: return {"hits": self.hits, "misses": self.misses, "shared": self.shared, "entries": len(self._entries)}
+
+@st.cache_resource
+def get_generation_cache() -> GenerationCache:
+    return GenerationCache(GENERATION_CACHE_TTL_SECONDS, GENERATION_CACHE_MAX_ENTRIES)
+
+def generate_images_uncached(cfg: Dict, client, params: Dict, on_image=None, warn=st.warning, cancel_event: threading.Event = None, queue_tag: str = None) -> Tuple[bool, any]:
+    with get_metrics().timer("flux_generation_batch_seconds", provider=cfg.get('provider'), model=params.get("model"), outcome="error") as labels:
+        success, result = _generate_images_uncached(cfg, client, params, on_image=on_image, warn=warn, cancel_event=cancel_event, queue_tag=queue_tag)
+        if success: labels["outcome"] = "ok" if len(result.data) == params.get("n", 1) else "partial"
+    return success, result
+
+def _generate_images_uncached(cfg: Dict, client, params: Dict, on_image=None, warn=st.warning, cancel_event: threading.Event = None, queue_tag: str = None) -> Tuple[bool, any]:
+    provider = cfg.get('provider')
+    n_images = params.get("n", 1)
+
+    if provider == "Pollinations.ai":
+        generated_images, errors = generate_pollinations_batch(cfg, params, n_images, on_image=on_image, cancel_event=cancel_event, queue_tag=queue_tag)
+        for error in errors: warn(error)
         if generated_images:
             response_obj = type('Response', (object,), {'data': generated_images})
             return True, response_obj
@@ -154,40 +1188,210 @@ def generate_images_with_retry(client, **params) -> Tuple[bool, any]:
         try:
             sdk_params = {"model": params.get("model"), "prompt": params.get("prompt"), "negative_prompt": params.get("negative_prompt"), "size": str(params.get("size")), "n": n_images, "response_format": "b64_json"}
             sdk_params = {k: v for k, v in sdk_params.items() if v is not None and v != ""}
-            return True, client.images.generate(**sdk_params)
+            if params.get("seed") is not None: sdk_params["extra_body"] = {"seed": params["seed"]}
+            response = call_with_resilience(cfg, lambda: client.images.generate(**sdk_params), cancelled=cancel_event, model=params.get("model"), priority=request_priority(n_images), queue_tag=queue_tag)
+            images = [type('Image', (object,), {'digest': store_image_bytes(decode_b64_image(img.b64_json, provider))}) for img in response.data if img.b64_json]
+            return True, type('Response', (object,), {'data': images})
         except Exception as e: return False, str(e)
     return False, "未知錯誤。"
 
-def add_to_history(prompt: str, negative_prompt: str, model: str, images: List[str], metadata: Dict):
-    history = st.session_state.generation_history
-    history.insert(0, {"id": str(uuid.uuid4()), "timestamp": datetime.datetime.now(), "prompt": prompt, "negative_prompt": negative_prompt, "model": model, "images": images, "metadata": metadata})
-    st.session_state.generation_history = history[:MAX_HISTORY_ITEMS]
+def get_failover_profiles(active_name: str) -> List[Tuple[str, Dict]]:
+    """同一提供商下其他已驗證的存檔 (模型名稱才能通用)，跳過正在熔斷的端點。"""
+    active_cfg = st.session_state.api_profiles.get(active_name, {})
+    registry = get_resilience_registry()
+    return [(name, cfg) for name, cfg in st.session_state.api_profiles.items() if name != active_name and cfg.get('validated') and cfg.get('provider') == active_cfg.get('provider') and get_profile_key(cfg) != get_profile_key(active_cfg) and not registry.breaker(cfg).is_open()]
+
+def generate_with_failover(cfg: Dict, client, params: Dict, fallbacks: List[Tuple[str, Dict]], on_image=None, warn=st.warning, cancel_event: threading.Event = None, queue_tag: str = None) -> Tuple[bool, any]:
+    success, result = generate_images_uncached(cfg, client, params, on_image=on_image, warn=warn, cancel_event=cancel_event, queue_tag=queue_tag)
+    for name, fallback_cfg in fallbacks:
+        if success or (cancel_event is not None and cancel_event.is_set()): break
+        warn(f"🔁 {result}，正在切換至存檔 '{name}'...")
+        fallback_client = get_connection_pool().openai_client(fallback_cfg) if fallback_cfg.get('provider') != "Pollinations.ai" else None
+        success, result = generate_images_uncached(fallback_cfg, fallback_client, params, on_image=on_image, warn=warn, cancel_event=cancel_event, queue_tag=queue_tag)
+    return success, result
+
+def run_generation(cfg: Dict, client, params: Dict, fallbacks: List[Tuple[str, Dict]] = (), on_image=None, warn=st.warning, cancel_event: threading.Event = None, queue_tag: str = None) -> Tuple[bool, any]:
+    """生成的唯一入口 (背景任務與基準測試都經由此處)：經過生成快取與單飛去重，上游請求再經排程器與重試。
+    不訪問 session_state，可在背景線程中執行。queue_tag 標記排程器中的請求，用於查詢排隊位置。"""
+    generate = lambda warn_fn: generate_with_failover(cfg, client, params, fallbacks, on_image=on_image, warn=warn_fn, cancel_event=cancel_event, queue_tag=queue_tag)
+    cache_key = GenerationCache.make_key(cfg, params)
+    if cache_key is None: return generate(warn)
+    return get_generation_cache().get_or_generate(cache_key, params.get("n", 1), generate, cancel_event=cancel_event, warn=warn)
+
+class GenerationJob:
+    def __init__(self, owner: str, params: Dict, meta: Dict):
+        self.id, self.owner, self.params, self.meta = str(uuid.uuid4()), owner, params, meta
+        self.status = "queued"  # queued -> running -> done / failed / cancelled
+        self.created_at, self.started_at, self.finished_at = time.time(), None, None
+        self.images: List[str] = []
+        self.warnings: List[str] = []
+        self.error, self.cached, self.collected, self.history_id = None, False, False, None
+        self.cancel_event = threading.Event()
+
+    @property
+    def active(self) -> bool: return self.status in ("queued", "running")
+
+class JobManager:
+    """全進程共用的背景生成任務池。提交後立即返回任務，每個用戶同時排隊/執行的任務數受限以保證公平。"""
+    def __init__(self, workers: int, max_active_per_user: int):
+        self.workers, self.max_active_per_user = workers, max_active_per_user
+        self._job_seconds = None  # 任務耗時的指數移動平均，用於估算排隊時間
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="flux-job")
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, GenerationJob]" = OrderedDict()
+
+    def submit(self, owner: str, params: Dict, meta: Dict, run) -> GenerationJob:
+        with self._lock:
+            self._prune_locked()
+            if sum(1 for job in self._jobs.values() if job.owner == owner and job.active) >= self.max_active_per_user:
+                raise RuntimeError(f"最多只能同時進行 {self.max_active_per_user} 個生成任務，請等待當前任務完成。")
+            job = GenerationJob(owner, params, meta)
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, run)
+        return job
+
+    def _run(self, job: GenerationJob, run):
+        if job.cancel_event.is_set(): job.status, job.finished_at = "cancelled", time.time(); return
+        job.status, job.started_at = "running", time.time()
+        try: success, result = run(job)
+        except Exception as e: success, result = False, str(e)
+        if success:
+            job.images, job.cached = [img.digest for img in result.data], getattr(result, 'cached', False)
+        else: job.error = result
+        job.status = "cancelled" if job.cancel_event.is_set() else ("done" if success else "failed")
+        job.finished_at = time.time()
+        if success:
+            with self._lock: self._job_seconds = job.finished_at - job.started_at if self._job_seconds is None else 0.8 * self._job_seconds + 0.2 * (job.finished_at - job.started_at)
+
+    def _prune_locked(self):
+        now = time.time()
+        for job_id in [job.id for job in self._jobs.values() if job.finished_at and (job.collected or now - job.finished_at > JOB_RETENTION_SECONDS)]: del self._jobs[job_id]
+
+    def cancel(self, owner: str, job_id: str):
+        job = self._jobs.get(job_id)
+        if job and job.owner == owner and job.active: job.cancel_event.set()
+
+    def all_jobs(self) -> List[GenerationJob]:
+        with self._lock: return list(self._jobs.values())
+
+    def jobs_for(self, owner: str) -> List[GenerationJob]:
+        with self._lock: return [job for job in self._jobs.values() if job.owner == owner]
+
+    def queue_position(self, job: GenerationJob) -> int:
+        with self._lock: return sum(1 for other in self._jobs.values() if other.status == "queued" and other.created_at < job.created_at)
+
+    def estimated_wait(self, position: int) -> float:
+        """按近期任務平均耗時估算排在第 position 位的任務還需等待多久；尚無數據時返回 None。"""
+        with self._lock: job_seconds = self._job_seconds
+        return None if job_seconds is None else (position // self.workers + 1) * job_seconds
+
+@st.cache_resource
+def get_job_manager() -> JobManager:
+    return JobManager(JOB_POOL_WORKERS, MAX_ACTIVE_JOBS_PER_USER)
 
-def display_image_with_actions(b64_json: str, image_id: str, history_item: Dict):
+def submit_generation_job(client, meta: Dict, failover: bool = False, **params) -> GenerationJob:
+    cfg = get_active_config()
+    fallbacks = get_failover_profiles(st.session_state.active_profile_name) if failover else []
+    def run(job: GenerationJob):
+        success, result = run_generation(cfg, client, params, fallbacks, on_image=lambda i, image_obj: job.images.append(image_obj.digest), warn=job.warnings.append, cancel_event=job.cancel_event, queue_tag=job.id)
+        # 在背景線程中直接寫入歷史，即使用戶離開頁面結果也不會丟失
+        if success and result.data: job.history_id = add_to_history(job.owner, meta['prompt'], meta['negative_prompt'], meta['model'], [img.digest for img in result.data], meta['metadata'])
+        return success, result
+    return get_job_manager().submit(st.session_state.user_id, params, meta, run)
+
+def collect_finished_jobs():
+    """顯示已結束的背景任務的結果通知，只在腳本線程中調用。"""
+    for job in get_job_manager().jobs_for(st.session_state.user_id):
+        if job.active or job.collected: continue
+        job.collected = True
+        if job.history_id: st.session_state.last_generation_id = job.history_id
+        # 取消的任務保留已完成的圖像 (已寫入歷史)，只顯示一條通知
+        if job.status == "cancelled":
+            st.session_state.job_notices.append(("info", "⏹️ 生成任務已取消" + (f"，已保存完成的 {len(job.images)} 張圖像。" if job.history_id else "。")))
+            continue
+        st.session_state.job_notices.extend(("warning", w) for w in job.warnings)
+        if job.history_id: st.session_state.job_notices.append(("success", f"✨ 成功生成 {len(job.images)} 張圖像！" + (" (來自快取)" if job.cached else "")))
+        if job.status == "failed": st.session_state.job_notices.append(("error", f"❌ 生成失敗: {job.error}"))
+
+def show_generation_jobs():
+    jobs = [job for job in get_job_manager().jobs_for(st.session_state.user_id) if not job.collected]
+    if any(not job.active for job in jobs): rerun_app()
+    for job in jobs:
+        n_images = job.params.get("n", 1)
+        with st.container(border=True):
+            if job.status == "queued":
+                position = get_job_manager().queue_position(job)
+                eta = get_job_manager().estimated_wait(position)
+                st.markdown(f"⏳ **排隊中** (前方 {position} 個任務{f'，預計約 {eta:.0f} 秒' if eta is not None else ''}) · {job.meta['prompt'][:40]}")
+            else:
+                st.markdown(f"🎨 **生成中** · {job.meta['prompt'][:40]}")
+                if (queued := get_request_scheduler().find(job.id)) is not None: st.caption(f"🚦 等待上游配額：前方 {queued['position']} 個請求，預計約 {queued['eta']:.0f} 秒")
+                st.progress(len(job.images) / n_images, text=f"{len(job.images)}/{n_images} 已完成")
+            if job.images:
+                cols = st.columns(min(n_images, 4))
+                for i, image_ref in enumerate(list(job.images)):
+                    if (img_data := get_image_store().read_thumbnail(image_ref)) is not None:
+                        with cols[i % len(cols)]: st.image(img_data, use_container_width=True)
+            if st.button("✖️ 取消", key=f"cancel_{job.id}", disabled=job.cancel_event.is_set()):
+                get_job_manager().cancel(st.session_state.user_id, job.id)
+
+def add_to_history(user_id: str, prompt: str, negative_prompt: str, model: str, images: List[str], metadata: Dict) -> str:
+    """images 為圖像庫中的 SHA-256 引用，返回歷史 id。"""
+    return get_history_db().add_history(user_id, prompt, negative_prompt, model, images, metadata)
+
+def cursor_page(key: str, fetch, page_size: int, reset_token=None) -> List[Dict]:
+    """fetch(cursor, limit) -> (items, next_cursor)。以游標棧實現上一頁/下一頁，reset_token 變化時回到第一頁。"""
+    if st.session_state.get(f"{key}_reset") != reset_token: st.session_state[f"{key}_cursors"], st.session_state[f"{key}_reset"] = [None], reset_token
+    cursors = st.session_state.setdefault(f"{key}_cursors", [None])
+    items, next_cursor = fetch(cursors[-1], page_size)
+    if len(cursors) > 1 or next_cursor:
+        prev_col, page_col, next_col = st.columns([1, 2, 1])
+        if prev_col.button("⬅️ 上一頁", key=f"{key}_prev", disabled=len(cursors) <= 1, use_container_width=True): cursors.pop(); rerun_app()
+        page_col.caption(f"第 {len(cursors)} 頁")
+        if next_col.button("下一頁 ➡️", key=f"{key}_next", disabled=not next_cursor, use_container_width=True): cursors.append(next_cursor); rerun_app()
+    return items
+
+def display_image_with_actions(image_ref: str, image_id: str, history_item: Dict):
+    metrics, start = get_metrics(), time.perf_counter()
     try:
-        img_data = base64.b64decode(b64_json)
-        st.image(Image.open(BytesIO(img_data)), use_container_width=True)
-        col1, col2, col3 = st.columns(3)
-        with col1: st.download_button("📥 下載", img_data, f"flux_{image_id}.png", "image/png", key=f"dl_{image_id}", use_container_width=True)
+        store = get_image_store()
+        expanded = image_id in st.session_state.expanded_images
+        img_data = store.read(image_ref) if expanded else store.read_thumbnail(image_ref)
+        if img_data is None: st.info("🗑️ 圖像已從本地快取中淘汰。"); return
+        st.image(img_data, use_container_width=True)
+        metrics.observe("flux_render_bytes", len(img_data), kind="full" if expanded else "thumb")
+        col1, col2, col3, col4 = st.columns(4)
+        with col1: st.download_button("📥", lambda: store.read(image_ref) or b"", f"flux_{image_id}.png", "image/png", key=f"dl_{image_id}", use_container_width=True, help="下載原圖")
+        with col4:
+            if st.button("🔽" if expanded else "🔍", key=f"expand_{image_id}", use_container_width=True, help="收起/查看原圖"):
+                st.session_state.expanded_images ^= {image_id}
+                rerun_app()
         with col2:
-            is_fav = any(fav['id'] == image_id for fav in st.session_state.favorite_images)
+            is_fav = image_id in st.session_state.favorite_ids
             if st.button("⭐" if is_fav else "☆", key=f"fav_{image_id}", use_container_width=True, help="收藏/取消收藏"):
-                if is_fav: st.session_state.favorite_images = [f for f in st.session_state.favorite_images if f['id'] != image_id]
-                else: st.session_state.favorite_images.append({"id": image_id, "image_b64": b64_json, "timestamp": datetime.datetime.now(), "history_item": history_item})
+                db = get_history_db()
+                if is_fav:
+                    if db.remove_favorite(st.session_state.user_id, image_id): store.release(image_ref)
+                elif db.add_favorite(st.session_state.user_id, image_id, image_ref, history_item.get('id')): store.retain(image_ref)
                 rerun_app()
         with col3:
-            if st.button("🎨 變體", key=f"vary_{image_id}", use_container_width=True, help="使用此提示生成變體"):
+            if st.button("🎨", key=f"vary_{image_id}", use_container_width=True, help="使用此提示生成變體"):
                 st.session_state.update({'vary_prompt': history_item['prompt'], 'vary_negative_prompt': history_item.get('negative_prompt', ''), 'vary_model': history_item['model']})
                 rerun_app()
     except Exception as e: st.error(f"圖像顯示錯誤: {e}")
+    finally: metrics.observe("flux_render_image_seconds", time.perf_counter() - start)
 
 def init_api_client():
     cfg = get_active_config()
     if cfg and cfg.get('api_key') and cfg.get('provider') != "Pollinations.ai":
-        try: return OpenAI(api_key=cfg['api_key'], base_url=cfg['base_url'])
+        try: return get_connection_pool().openai_client(cfg)
         except Exception: return None
     return None
 
+def auto_refresh(fn, run_every: float):
+    fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None)
+    return fragment(run_every=run_every)(fn) if fragment else fn
+
 def editor_provider_changed():
     provider = st.session_state.editor_provider_selectbox
     st.session_state.editor_base_url = API_PROVIDERS[provider]['base_url_default']
@@ -212,7 +1416,6 @@ def show_api_settings():
     if st.session_state.get('active_profile_name') != active_profile_name or 'profile_being_edited' not in st.session_state or st.session_state.profile_being_edited != active_profile_name:
         st.session_state.active_profile_name = active_profile_name
         load_profile_to_editor_state(active_profile_name)
-        st.session_state.discovered_models = {}
         rerun_app()
 
     col1, col2 = st.columns(2)
@@ -226,6 +1429,7 @@ def show_api_settings():
     with col2:
         if st.button("🗑️ 刪除當前存檔", use_container_width=True, disabled=len(profile_names) <= 1 or not active_profile_name):
             if active_profile_name:
+                get_connection_pool().invalidate(st.session_state.api_profiles[active_profile_name])
                 del st.session_state.api_profiles[active_profile_name]
                 st.session_state.active_profile_name = list(st.session_state.api_profiles.keys())[0]
                 rerun_app()
@@ -247,8 +1451,11 @@ def show_api_settings():
                 if provider == "Pollinations.ai":
                     new_config.update({'api_key': '', 'pollinations_auth_mode': st.session_state.editor_auth_mode, 'pollinations_referrer': st.session_state.editor_referrer, 'pollinations_token': st.session_state.editor_token})
                 else: new_config.update({'api_key': st.session_state.editor_api_key, 'pollinations_auth_mode': '免費', 'pollinations_referrer': '', 'pollinations_token': ''})
-                is_valid, msg = validate_api_key(new_config['api_key'], new_config['base_url'], new_config['provider'])
+                old_config = st.session_state.api_profiles.get(active_profile_name, {})
+                new_config.update({k: old_config[k] for k in SCHEDULER_OVERRIDE_KEYS if k in old_config})  # 編輯器不提供限速欄位，保留存檔原有的覆蓋值
+                is_valid, msg = validate_api_key(new_config)
                 new_config['validated'] = is_valid
+                if get_profile_key(old_config) != get_profile_key(new_config): get_connection_pool().invalidate(old_config)
                 new_name = st.session_state.editor_profile_name
                 if new_name != active_profile_name: del st.session_state.api_profiles[active_profile_name]
                 st.session_state.api_profiles[new_name] = new_config
@@ -256,94 +1463,135 @@ def show_api_settings():
                 st.success(f"存檔 '{new_name}' 已保存。")
                 time.sleep(1); rerun_app()
 
-init_session_state()
-client = init_api_client()
-cfg = get_active_config()
-api_configured = cfg and cfg.get('validated', False)
-
-# --- 側邊欄 ---
-with st.sidebar:
-    show_api_settings()
-    st.markdown("---")
-    if api_configured:
-        st.success(f"🟢 活動存檔: '{st.session_state.active_profile_name}'")
-        can_discover = (client is not None) or (cfg.get('provider') == "Pollinations.ai")
-        if st.button("🔍 發現模型", use_container_width=True, disabled=not can_discover):
-            with st.spinner("🔍 正在發現模型..."):
-                discovered = auto_discover_models(client, cfg['provider'], cfg['base_url'])
-                st.session_state.discovered_models = discovered
-                st.success(f"發現 {len(discovered)} 個模型！") if discovered else st.warning("未發現任何模型。")
-                time.sleep(1); rerun_app()
-    elif st.session_state.api_profiles: st.error(f"🔴 '{st.session_state.active_profile_name}' 未驗證")
-    st.markdown("---")
-    st.info(f"⚡ **免費版優化**\n- 歷史: {MAX_HISTORY_ITEMS}\n- 收藏: {MAX_FAVORITE_ITEMS}")
+def main():
+    """整次腳本執行計時 (rerun 以異常跳出，故用 finally)，並記錄本會話 session_state 的估算大小。"""
+    start_metrics_exporters()
+    metrics, start = get_metrics(), time.perf_counter()
+    try: render_page()
+    finally:
+        metrics.observe("flux_script_run_seconds", time.perf_counter() - start)
+        if 'user_id' in st.session_state: metrics.set("flux_session_state_bytes", estimate_size({key: st.session_state[key] for key in st.session_state}), session=st.session_state.user_id[:8])
+
+def render_page():
+    init_session_state()
+    collect_finished_jobs()
+    history_db = get_history_db()
+    st.session_state.favorite_ids = history_db.favorite_ids(st.session_state.user_id)
+    client = init_api_client()
+    cfg = get_active_config()
+    api_configured = cfg and cfg.get('validated', False)
+
+    # --- 側邊欄 ---
+    with st.sidebar:
+        show_api_settings()
+        st.markdown("---")
+        if api_configured:
+            st.success(f"🟢 活動存檔: '{st.session_state.active_profile_name}'")
+            can_discover = (client is not None) or (cfg.get('provider') == "Pollinations.ai")
+            if st.button("🔍 發現模型", use_container_width=True, disabled=not can_discover):
+                with st.spinner("🔍 正在發現模型..."):
+                    discovered = auto_discover_models(client, cfg['provider'], cfg['base_url'])
+                    st.success(f"發現 {len(discovered)} 個模型！") if discovered else st.warning("未發現任何模型。")
+                    time.sleep(1); rerun_app()
+            registry_info = get_model_registry().info(cfg['provider'], cfg['base_url'])
+            if registry_info.get('fetched_at'): st.caption(f"📋 模型列表更新於 {datetime.datetime.fromtimestamp(registry_info['fetched_at']).strftime('%H:%M:%S')}" + (f" (刷新失敗: {registry_info['error']})" if registry_info.get('error') else ""))
+        elif st.session_state.api_profiles: st.error(f"🔴 '{st.session_state.active_profile_name}' 未驗證")
+        st.markdown("---")
+        st.info("💾 **本地持久化**\n- 歷史與收藏保存在本地資料庫\n- 收藏此頁網址 (含 uid) 即可找回")
+        pool_stats = get_connection_pool().stats()
+        st.caption(f"🔌 連線池: 命中 {pool_stats['hits']} / 未命中 {pool_stats['misses']} | 會話 {pool_stats['sessions']} · 客戶端 {pool_stats['clients']}")
+        cache_stats = get_generation_cache().stats()
+        st.caption(f"🗃️ 生成快取: 命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']} | 共享 {cache_stats['shared']} · 條目 {cache_stats['entries']}")
+        if api_configured:
+            scheduler_status = get_request_scheduler().get(cfg).status()
+            st.caption(f"🚦 上游排程: 排隊 {scheduler_status['waiting']} · 進行中 {scheduler_status['active']}/{scheduler_status['max_concurrency']} · 可用令牌 {scheduler_status['tokens']:.1f}")
+        if is_admin_mode(): show_metrics_panel()
 
-st.title("🏆 FLUX AI (終極模型版)")
+    st.title("🏆 FLUX AI (終極模型版)")
 
-# --- 主介面 ---
-tab1, tab2, tab3 = st.tabs(["🚀 生成圖像", f"📚 歷史 ({len(st.session_state.generation_history)})", f"⭐ 收藏 ({len(st.session_state.favorite_images)})"])
+    # --- 主介面 ---
+    all_models = merge_models() if api_configured else {}
+    tab1, tab2, tab3 = st.tabs(["🚀 生成圖像", f"📚 歷史 ({history_db.count_history(st.session_state.user_id)})", f"⭐ 收藏 ({len(st.session_state.favorite_ids)})"])
 
-with tab1:
-    if not api_configured: st.warning("⚠️ 請在側邊欄選擇一個已驗證的存檔，或新增一個。")
-    else:
-        all_models = merge_models()
-        if not all_models: st.warning("⚠️ 未發現任何模型。請點擊側邊欄的「發現模型」。")
+    with tab1:
+        if not api_configured: st.warning("⚠️ 請在側邊欄選擇一個已驗證的存檔，或新增一個。")
         else:
-            prompt_default = st.session_state.pop('vary_prompt', '')
-            neg_prompt_default = st.session_state.pop('vary_negative_prompt', '')
-            model_default_key = st.session_state.pop('vary_model', list(all_models.keys())[0])
-            model_default_index = list(all_models.keys()).index(model_default_key) if model_default_key in all_models else 0
-
-            sel_model = st.selectbox("模型:", list(all_models.keys()), index=model_default_index, format_func=lambda x: f"{all_models.get(x, {}).get('icon', '🤖')} {all_models.get(x, {}).get('name', x)}")
-            n_images = st.slider("生成數量", 1, MAX_BATCH_SIZE, 1)
-            selected_style = st.selectbox("🎨 風格預設:", list(STYLE_PRESETS.keys()))
-            prompt_val = st.text_area("✍️ 提示詞:", value=prompt_default, height=100, placeholder="一隻貓在日落下飛翔，電影感，高品質")
-            negative_prompt_val = st.text_area("🚫 負向提示詞:", value=neg_prompt_default, height=50, placeholder="模糊, 糟糕的解剖結構, 文字, 水印")
-            size_preset = st.selectbox("圖像尺寸", options=list(IMAGE_SIZES.keys()), format_func=lambda x: IMAGE_SIZES[x])
-            final_size_str = size_preset
-            if size_preset == "自定義...":
-                w, h = st.columns(2)
-                width = w.slider("寬度", 256, 2048, 1024, 64)
-                height = h.slider("高度", 256, 2048, 1024, 64)
-                final_size_str = f"{width}x{height}"
-            
-            enhance, private, nologo, safe = False, False, False, False
-            if cfg.get('provider') == "Pollinations.ai":
-                with st.expander("🌸 Pollinations.ai 進階選項"):
-                    enhance, private, nologo, safe = st.checkbox("增強提示詞", True), st.checkbox("私密模式", True), st.checkbox("移除標誌", True), st.checkbox("安全模式", False)
-
-            if st.button("🚀 生成圖像", type="primary", use_container_width=True, disabled=not prompt_val.strip()):
-                final_prompt = f"{prompt_val}, {STYLE_PRESETS[selected_style]}" if selected_style != "無" and STYLE_PRESETS[selected_style] else prompt_val
-                with st.spinner(f"🎨 正在生成 {n_images} 張圖像..."):
-                    params = {"model": sel_model, "prompt": final_prompt, "negative_prompt": negative_prompt_val, "size": final_size_str, "n": n_images, "enhance": enhance, "private": private, "nologo": nologo, "safe": safe}
-                    success, result = generate_images_with_retry(client, **params)
-                    if success and result.data:
-                        img_b64s = [img.b64_json for img in result.data]
-                        add_to_history(prompt_val, negative_prompt_val, sel_model, img_b64s, {"size": final_size_str, "provider": cfg['provider'], "style": selected_style, "n": n_images})
-                        st.success(f"✨ 成功生成 {len(img_b64s)} 張圖像！")
-                        cols = st.columns(min(len(img_b64s), 2))
-                        for i, b64_json in enumerate(img_b64s):
-                            with cols[i % 2]: display_image_with_actions(b64_json, f"{st.session_state.generation_history[0]['id']}_{i}", st.session_state.generation_history[0])
-                        gc.collect()
-                    else: st.error(f"❌ 生成失敗: {result}")
-
-with tab2:
-    if not st.session_state.generation_history: st.info("📭 尚無生成歷史。")
-    else:
-        for item in st.session_state.generation_history:
-            with st.expander(f"🎨 {item['prompt'][:50]}... | {item['timestamp'].strftime('%m-%d %H:%M')}"):
-                model_name = merge_models().get(item['model'], {}).get('name', item['model'])
-                st.markdown(f"**提示詞**: {item['prompt']}\n\n**模型**: {model_name}")
-                if item.get('negative_prompt'): st.markdown(f"**負向提示詞**: {item['negative_prompt']}")
-                cols = st.columns(min(len(item['images']), 2))
-                for i, b64_json in enumerate(item['images']):
-                    with cols[i % 2]: display_image_with_actions(b64_json, f"hist_{item['id']}_{i}", item)
-
-with tab3:
-    if not st.session_state.favorite_images: st.info("⭐ 尚無收藏的圖像。")
-    else:
-        cols = st.columns(3)
-        for i, fav in enumerate(sorted(st.session_state.favorite_images, key=lambda x: x['timestamp'], reverse=True)):
-            with cols[i % 3]: display_image_with_actions(fav['image_b64'], fav['id'], fav.get('history_item'))
-
-st.markdown("""<div style="text-align: center; color: #888; margin-top: 2rem;"><small>🏆 終極模型版 | 部署在雲端平台 🏆</small></div>""", unsafe_allow_html=True)
+            if not all_models: st.warning("⚠️ 未發現任何模型。請點擊側邊欄的「發現模型」。")
+            else:
+                prompt_default = st.session_state.pop('vary_prompt', '')
+                neg_prompt_default = st.session_state.pop('vary_negative_prompt', '')
+                model_default_key = st.session_state.pop('vary_model', list(all_models.keys())[0])
+                model_default_index = list(all_models.keys()).index(model_default_key) if model_default_key in all_models else 0
+
+                sel_model = st.selectbox("模型:", list(all_models.keys()), index=model_default_index, format_func=lambda x: f"{all_models.get(x, {}).get('icon', '🤖')} {all_models.get(x, {}).get('name', x)}")
+                n_images = st.slider("生成數量", 1, MAX_BATCH_SIZE, 1)
+                selected_style = st.selectbox("🎨 風格預設:", list(STYLE_PRESETS.keys()))
+                prompt_val = st.text_area("✍️ 提示詞:", value=prompt_default, height=100, placeholder="一隻貓在日落下飛翔，電影感，高品質")
+                negative_prompt_val = st.text_area("🚫 負向提示詞:", value=neg_prompt_default, height=50, placeholder="模糊, 糟糕的解剖結構, 文字, 水印")
+                size_preset = st.selectbox("圖像尺寸", options=list(IMAGE_SIZES.keys()), format_func=lambda x: IMAGE_SIZES[x])
+                final_size_str = size_preset
+                if size_preset == "自定義...":
+                    w, h = st.columns(2)
+                    width = w.slider("寬度", 256, 2048, 1024, 64)
+                    height = h.slider("高度", 256, 2048, 1024, 64)
+                    final_size_str = f"{width}x{height}"
+
+                seed = None
+                if st.checkbox("🎲 固定種子", False, help="使用固定種子可重現結果；相同的請求會直接返回快取的圖像。部分 OpenAI 兼容端點可能不支持種子參數。"):
+                    seed = int(st.number_input("種子", min_value=0, max_value=1000000, value=42, step=1))
+
+                enhance, private, nologo, safe = False, False, False, False
+                if cfg.get('provider') == "Pollinations.ai":
+                    with st.expander("🌸 Pollinations.ai 進階選項"):
+                        enhance, private, nologo, safe = st.checkbox("增強提示詞", True), st.checkbox("私密模式", True), st.checkbox("移除標誌", True), st.checkbox("安全模式", False)
+
+                failover = st.checkbox("🔁 自動故障轉移", False, help="當前存檔失敗或熔斷時，自動改用同一提供商下其他已驗證的存檔。")
+
+                if st.button("🚀 生成圖像", type="primary", use_container_width=True, disabled=not prompt_val.strip()):
+                    final_prompt = f"{prompt_val}, {STYLE_PRESETS[selected_style]}" if selected_style != "無" and STYLE_PRESETS[selected_style] else prompt_val
+                    params = {"model": sel_model, "prompt": final_prompt, "negative_prompt": negative_prompt_val, "size": final_size_str, "n": n_images, "seed": seed, "enhance": enhance, "private": private, "nologo": nologo, "safe": safe}
+                    meta = {"prompt": prompt_val, "negative_prompt": negative_prompt_val, "model": sel_model, "metadata": {"size": final_size_str, "provider": cfg['provider'], "style": selected_style, "n": n_images, "seed": seed}}
+                    try: submit_generation_job(client, meta, failover=failover, **params)
+                    except RuntimeError as e: st.warning(f"⚠️ {e}")
+
+        for level, message in st.session_state.job_notices: getattr(st, level)(message)
+        st.session_state.job_notices = []
+        has_active_jobs = any(job.active for job in get_job_manager().jobs_for(st.session_state.user_id))
+        (auto_refresh(show_generation_jobs, JOB_POLL_SECONDS) if has_active_jobs else show_generation_jobs)()
+        latest = history_db.get_history(st.session_state.user_id, st.session_state.last_generation_id) if st.session_state.get('last_generation_id') else None
+        if latest:
+            cols = st.columns(min(len(latest['images']), 2))
+            for i, image_ref in enumerate(latest['images']):
+                with cols[i % 2]: display_image_with_actions(image_ref, f"{latest['id']}_{i}", latest)
+
+    with tab2:
+        if not history_db.count_history(st.session_state.user_id): st.info("📭 尚無生成歷史。")
+        else:
+            search_col, model_col = st.columns([3, 1])
+            search = search_col.text_input("🔎 搜索提示詞", key="history_search")
+            model_filter = model_col.selectbox("模型", ["全部"] + history_db.history_models(st.session_state.user_id), key="history_model")
+            model_filter = None if model_filter == "全部" else model_filter
+            items = cursor_page("history", lambda cursor, limit: history_db.history_page(st.session_state.user_id, limit, cursor, search, model_filter), HISTORY_PAGE_SIZE, reset_token=(search, model_filter))
+            if not items: st.info("🔎 沒有符合條件的記錄。")
+            for item in items:
+                with st.expander(f"🎨 {item['prompt'][:50]}... | {item['timestamp'].strftime('%m-%d %H:%M')}"):
+                    model_name = all_models.get(item['model'], {}).get('name', item['model'])
+                    st.markdown(f"**提示詞**: {item['prompt']}\n\n**模型**: {model_name}")
+                    if item.get('negative_prompt'): st.markdown(f"**負向提示詞**: {item['negative_prompt']}")
+                    cols = st.columns(min(len(item['images']), 2))
+                    for i, image_ref in enumerate(item['images']):
+                        with cols[i % 2]: display_image_with_actions(image_ref, f"hist_{item['id']}_{i}", item)
+
+    with tab3:
+        if not st.session_state.favorite_ids: st.info("⭐ 尚無收藏的圖像。")
+        else:
+            favorites = cursor_page("favorites", lambda cursor, limit: history_db.favorites_page(st.session_state.user_id, limit, cursor), FAVORITES_PAGE_SIZE)
+            cols = st.columns(3)
+            for i, fav in enumerate(favorites):
+                with cols[i % 3]: display_image_with_actions(fav['image_ref'], fav['id'], fav.get('history_item'))
+
+    st.markdown("""<div style="text-align: center; color: #888; margin-top: 2rem;"><small>🏆 終極模型版 | 部署在雲端平台 🏆</small></div>""", unsafe_allow_html=True)
+
+# streamlit run 以 __main__ 執行腳本；被 import 時 (如 benchmark.py) 只載入函數，不渲染介面
+if __name__ == "__main__":
+    main()
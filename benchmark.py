@@ -0,0 +1,239 @@
+"""離線基準測試：以本地模擬供應商驅動 app.py 的生成與歷史渲染路徑，不啟動 Streamlit 介面。
+
+用法示例:
+    python benchmark.py --provider pollinations --requests 40 --batch 4 --sessions 8 --latency 0.5 --error-rate 0.05
+    python benchmark.py --provider openai --image-size 2048 --json result.json
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from urllib.parse import urlparse
+
+from PIL import Image
+
+POLLINATIONS_MODELS = ["flux", "flux-realism", "turbo"]
+OPENAI_MODELS = ["flux.1-schnell", "flux.1-dev", "gpt-image-1"]
+
+
+class MockProvider:
+    """同時模擬 Pollinations (/prompt/..., /models) 與 OpenAI (/v1/images/generations, /v1/models) 的本地服務。"""
+    def __init__(self, latency: float, jitter: float, error_rate: float, retry_after: str, image_size: int, image_format: str):
+        self.latency, self.jitter, self.error_rate, self.retry_after = latency, jitter, error_rate, retry_after
+        image = Image.frombytes("RGB", (image_size, image_size), os.urandom(image_size * image_size * 3))
+        buffer = BytesIO()
+        image.save(buffer, image_format)
+        self.payload, self.content_type = buffer.getvalue(), f"image/{image_format.lower()}"
+        self.payload_b64 = base64.b64encode(self.payload).decode()
+        self._lock = threading.Lock()
+        self.requests, self.errors, self.bytes_sent = 0, 0, 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self) -> "MockProvider":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self): self.server.shutdown()
+
+    def _count(self, sent: int, error: bool = False):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+            self.errors += int(error)
+
+    def _handler(self):
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # 保持連線，與真實端點一致
+
+            def log_message(self, *args): pass
+
+            def _send(self, status: int, body: bytes = b"", content_type: str = "application/json", headers: dict = None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items(): self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+                provider._count(len(body), error=status >= 500 or status == 429)
+
+            def _simulate_upstream(self) -> bool:
+                time.sleep(max(0.0, random.gauss(provider.latency, provider.jitter)))
+                if random.random() < provider.error_rate:
+                    self._send(503, b'{"error": "mock overload"}', headers={"Retry-After": provider.retry_after} if provider.retry_after else None)
+                    return False
+                return True
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path == "/models":
+                    etag = '"pollinations-models-v1"'
+                    if self.headers.get("If-None-Match") == etag: return self._send(304, headers={"ETag": etag})
+                    return self._send(200, json.dumps(POLLINATIONS_MODELS).encode(), headers={"ETag": etag})
+                if path == "/v1/models":
+                    return self._send(200, json.dumps({"object": "list", "data": [{"id": m, "object": "model", "created": 0, "owned_by": "mock"} for m in OPENAI_MODELS]}).encode())
+                if path.startswith("/prompt/"):
+                    if self._simulate_upstream(): self._send(200, provider.payload, provider.content_type)
+                    return
+                self._send(404, b'{"error": "not found"}')
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                if urlparse(self.path).path != "/v1/images/generations": return self._send(404, b'{"error": "not found"}')
+                if not self._simulate_upstream(): return
+                data = [{"b64_json": provider.payload_b64} for _ in range(int(body.get("n", 1)))]
+                self._send(200, json.dumps({"created": int(time.time()), "data": data}).encode())
+
+        return Handler
+
+
+def percentile(values, q: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(latencies, elapsed: float, units: int) -> dict:
+    return {"count": len(latencies), "throughput_per_s": units / elapsed if elapsed else 0.0, "p50_ms": percentile(latencies, 50) * 1000, "p95_ms": percentile(latencies, 95) * 1000, "p99_ms": percentile(latencies, 99) * 1000, "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0}
+
+
+def peak_rss_bytes() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def bench_generation(app, cfg: dict, client, args, mock: MockProvider) -> dict:
+    params = {"model": "flux" if cfg['provider'] == "Pollinations.ai" else "flux.1-schnell", "negative_prompt": "", "size": f"{args.image_size}x{args.image_size}", "n": args.batch, "seed": args.seed, "enhance": False, "private": True, "nologo": True, "safe": False}
+    latencies, image_refs, failures = [], [], []
+    sent_before = mock.bytes_sent
+
+    def one_request(i: int):
+        start = time.perf_counter()
+        success, result = app.run_generation(cfg, client, {**params, "prompt": f"benchmark prompt {i if args.seed is None else 0}"}, warn=lambda message: None)
+        latencies.append(time.perf_counter() - start)
+        if success: image_refs.extend(img.digest for img in result.data)
+        else: failures.append(str(result))
+
+    if args.trace_memory: tracemalloc.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool: list(pool.map(one_request, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    heap_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    if args.trace_memory: tracemalloc.stop()
+
+    result = summarize(latencies, elapsed, len(image_refs))
+    result.update(images=len(image_refs), failed_requests=len(failures), upstream_requests=mock.requests, upstream_errors=mock.errors, payload_bytes_per_image=(mock.bytes_sent - sent_before) / max(1, len(image_refs)))
+    if heap_peak is not None: result["heap_peak_bytes_per_inflight_image"] = heap_peak / max(1, args.sessions * args.batch)
+    if failures: result["sample_failure"] = failures[0]
+    result["_image_refs"] = image_refs
+    return result
+
+
+def bench_discovery(app, cfg: dict, client, rounds: int) -> dict:
+    latencies, registry = [], app.get_model_registry()
+    for _ in range(rounds):
+        start = time.perf_counter()
+        registry.refresh(cfg['provider'], cfg['base_url'], client)
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(rounds): registry.merged(cfg['provider'], cfg['base_url'], client)
+    result = summarize(latencies, sum(latencies), rounds)
+    result["merged_lookup_us"] = (time.perf_counter() - start) / rounds * 1e6
+    return result
+
+
+def bench_history_render(app, image_refs, page_size: int, pages: int) -> dict:
+    st, db, user_id = app.st, app.get_history_db(), "benchmark-user"
+    for i in range(0, len(image_refs), 4): db.add_history(user_id, f"benchmark prompt {i}", "", "flux", image_refs[i:i + 4], {"n": 4})
+    st.session_state.update(user_id=user_id, expanded_images=set(), favorite_ids=db.favorite_ids(user_id))
+    latencies, rendered, cursor = [], 0, None
+    for _ in range(pages):
+        start = time.perf_counter()
+        items, cursor = db.history_page(user_id, page_size, cursor)
+        for item in items:
+            for i, image_ref in enumerate(item['images']):
+                app.display_image_with_actions(image_ref, f"hist_{item['id']}_{i}", item)
+                rendered += 1
+        latencies.append(time.perf_counter() - start)
+        if not cursor: break
+    result = summarize(latencies, sum(latencies), rendered)
+    result["images_rendered"] = rendered
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FLUX AI 生成路徑離線基準測試")
+    parser.add_argument("--provider", choices=["pollinations", "openai"], default="pollinations")
+    parser.add_argument("--requests", type=int, default=20, help="生成請求總數")
+    parser.add_argument("--batch", type=int, default=4, help="每個請求的圖像數")
+    parser.add_argument("--sessions", type=int, default=4, help="同時發起請求的模擬會話數")
+    parser.add_argument("--seed", type=int, default=None, help="固定種子 (會命中生成快取)")
+    parser.add_argument("--latency", type=float, default=0.3, help="模擬上游平均延遲 (秒)")
+    parser.add_argument("--jitter", type=float, default=0.05, help="延遲標準差 (秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="上游返回 503 的機率")
+    parser.add_argument("--retry-after", default="", help="503 響應附帶的 Retry-After 值")
+    parser.add_argument("--image-size", type=int, default=1024, help="模擬圖像邊長 (像素)")
+    parser.add_argument("--image-format", choices=["JPEG", "PNG"], default="JPEG")
+    parser.add_argument("--rate-limit", type=float, default=None, help="存檔的每分鐘上游請求上限；預設不限速 (只測量應用本身)，0 表示使用提供商預設值")
+    parser.add_argument("--discovery-rounds", type=int, default=20)
+    parser.add_argument("--render-pages", type=int, default=5)
+    parser.add_argument("--trace-memory", action="store_true", help="以 tracemalloc 記錄 Python 堆峰值 (會降低吞吐)")
+    parser.add_argument("--json", help="把結果寫入 JSON 檔案")
+    parser.add_argument("--metrics", help="把 app 收集的 Prometheus 指標寫入檔案")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="flux_bench_")
+    os.environ.setdefault("FLUX_IMAGE_STORE_DIR", os.path.join(workdir, "images"))
+    os.environ.setdefault("FLUX_HISTORY_DB", os.path.join(workdir, "history.sqlite3"))
+    mock = MockProvider(args.latency, args.jitter, args.error_rate, args.retry_after, args.image_size, args.image_format).start()
+    # streamlit 讀取配置時會按 logger.level 重設所有日誌的級別，set_log_level 會被覆蓋；
+    # 改為停用裸模式下必然出現的 ScriptRunContext、session_state、「請用 streamlit run」(經由 streamlit 根日誌器) 與棄用提示的日誌器 (disabled 不受重設影響)
+    for name in ("streamlit.runtime.scriptrunner_utils.script_run_context", "streamlit.runtime.state.session_state_proxy", "streamlit", "streamlit.deprecation_util"): logging.getLogger(name).disabled = True
+    import app  # 環境變量須在 import 前設定
+
+    if args.provider == "pollinations":
+        cfg = {'provider': 'Pollinations.ai', 'api_key': '', 'base_url': mock.url, 'validated': True, 'pollinations_auth_mode': '免費', 'pollinations_token': '', 'pollinations_referrer': ''}
+        client = None
+    else:
+        cfg = {'provider': 'OpenAI Compatible', 'api_key': 'benchmark', 'base_url': f"{mock.url}/v1", 'validated': True}
+        client = app.get_connection_pool().openai_client(cfg)
+    if args.rate_limit is None: cfg.update(rate_limit_per_minute=1e9, burst=10 ** 6)
+    elif args.rate_limit: cfg.update(rate_limit_per_minute=args.rate_limit, burst=max(args.batch, args.sessions))
+    scheduler = app.get_request_scheduler().get(cfg)
+
+    results = {"config": {k: v for k, v in vars(args).items() if k not in ("json", "metrics")}, "payload_bytes": len(mock.payload)}
+    results["scheduler"] = {"rate_limit_per_minute": "unlimited" if args.rate_limit is None else scheduler.rate * 60, "burst": scheduler.burst, "max_concurrency": scheduler.max_concurrency}
+    results["generation"] = bench_generation(app, cfg, client, args, mock)
+    image_refs = results["generation"].pop("_image_refs")
+    results["discovery"] = bench_discovery(app, cfg, client, args.discovery_rounds)
+    results["history_render"] = bench_history_render(app, image_refs, app.HISTORY_PAGE_SIZE, args.render_pages)
+    results["peak_rss_bytes"] = peak_rss_bytes()
+    results["connection_pool"] = app.get_connection_pool().stats()
+    mock.stop()
+
+    for section in ("scheduler", "generation", "discovery", "history_render"):
+        print(f"[{section}]")
+        for key, value in results[section].items(): print(f"  {key:<36} {value:,.2f}" if isinstance(value, float) else f"  {key:<36} {value}")
+    print(f"[process]\n  {'peak_rss_mb':<36} {results['peak_rss_bytes'] / 2 ** 20:,.1f}\n  {'connection_pool':<36} {results['connection_pool']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f: f.write(app.render_metrics())
+
+
+if __name__ == "__main__":
+    main()
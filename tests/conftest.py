@@ -0,0 +1,14 @@
+"""app.py 在模組層讀取環境變量，須在 import 前指向臨時目錄；以裸模式載入 (不渲染介面)。"""
+import logging
+import os
+import sys
+import tempfile
+
+_workdir = tempfile.mkdtemp(prefix="flux_tests_")
+os.environ["FLUX_IMAGE_STORE_DIR"] = os.path.join(_workdir, "images")
+os.environ["FLUX_HISTORY_DB"] = os.path.join(_workdir, "history.sqlite3")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streamlit.logger  # noqa: E402
+
+streamlit.logger.set_log_level(logging.ERROR)
@@ -0,0 +1,34 @@
+import app
+
+
+def test_profile_key_ignores_fields_the_provider_does_not_use():
+    saved = {'provider': 'OpenAI Compatible', 'api_key': 'sk-1', 'base_url': 'http://x/v1', 'pollinations_auth_mode': '免費', 'pollinations_token': '', 'pollinations_referrer': '', 'validated': True}
+    assert app.get_profile_key(saved) == app.get_profile_key({'provider': 'OpenAI Compatible', 'api_key': 'sk-1', 'base_url': 'http://x/v1'})
+    assert app.get_profile_key(saved) != app.get_profile_key({**saved, 'api_key': 'sk-2'})
+
+
+def test_pollinations_key_depends_on_active_auth_mode_only():
+    base = {'provider': 'Pollinations.ai', 'base_url': 'http://p', 'api_key': ''}
+    assert app.get_profile_key(base) == app.get_profile_key({**base, 'pollinations_auth_mode': '免費', 'pollinations_token': 'unused'})
+    assert app.get_profile_key({**base, 'pollinations_auth_mode': '令牌', 'pollinations_token': 'a'}) != app.get_profile_key({**base, 'pollinations_auth_mode': '令牌', 'pollinations_token': 'b'})
+
+
+def test_invalidate_drops_client_created_during_validation():
+    pool = app.ConnectionPool()
+    cfg = {'provider': 'OpenAI Compatible', 'api_key': 'sk-1', 'base_url': 'http://127.0.0.1:9/v1', 'pollinations_auth_mode': '免費', 'validated': False}
+    pool.openai_client(cfg)
+    pool.invalidate({**cfg, 'validated': True})
+    assert pool.stats()["clients"] == 0
+
+
+def test_invalidate_does_not_close_clients_still_held_by_jobs():
+    pool = app.ConnectionPool()
+    cfg = {'provider': 'Pollinations.ai', 'base_url': 'http://127.0.0.1:9'}
+    session = pool.http_session(cfg)
+    pool.invalidate(cfg)
+    assert pool.http_session(cfg) is not session
+    assert session.adapters  # requests.Session.close() 會清空 adapters
+    openai_cfg = {'provider': 'OpenAI Compatible', 'api_key': 'sk-1', 'base_url': 'http://127.0.0.1:9/v1'}
+    client = pool.openai_client(openai_cfg)
+    pool.invalidate(openai_cfg)
+    assert not client.is_closed()
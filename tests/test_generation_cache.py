@@ -0,0 +1,105 @@
+import threading
+import time
+
+import app
+
+
+def response(digests):
+    return True, type('Response', (object,), {'data': [type('Image', (object,), {'digest': d}) for d in digests]})
+
+
+def test_concurrent_identical_requests_share_one_generation():
+    cache, calls, release = app.GenerationCache(ttl=60, max_entries=8), [], threading.Event()
+    digest = app.get_image_store().put(b"single-flight")
+
+    def generate(warn):
+        calls.append(1)
+        release.wait(5)
+        return response([digest])
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_generate("k", 1, generate))) for _ in range(3)]
+    for t in threads: t.start()
+    time.sleep(0.1)
+    release.set()
+    for t in threads: t.join()
+    assert len(calls) == 1 and all(success for success, _ in results)
+    assert cache.stats()["shared"] == 2
+    success, cached = cache.get_or_generate("k", 1, generate)
+    assert success and cached.cached and len(calls) == 1
+
+
+def test_cache_does_not_pin_images_and_treats_evicted_refs_as_misses():
+    cache, store = app.GenerationCache(ttl=60, max_entries=8), app.get_image_store()
+    digest = store.put(b"evictable")
+    cache.get_or_generate("k", 1, lambda warn: response([digest]))
+    assert not store._refcounts.get(digest)
+    with store._lock: store._remove_locked(digest)
+    calls = []
+    cache.get_or_generate("k", 1, lambda warn: calls.append(1) or response([store.put(b"evictable")]))
+    assert calls == [1]
+
+
+def test_store_purges_expired_entries():
+    cache, digest = app.GenerationCache(ttl=0.01, max_entries=8), app.get_image_store().put(b"expiring")
+    cache.get_or_generate("a", 1, lambda warn: response([digest]))
+    time.sleep(0.02)
+    cache.get_or_generate("b", 1, lambda warn: response([digest]))
+    assert cache.stats()["entries"] == 1
+
+
+def test_cancelled_follower_stops_waiting_for_the_leader():
+    cache, release, cancel = app.GenerationCache(ttl=60, max_entries=8), threading.Event(), threading.Event()
+    digest = app.get_image_store().put(b"slow-leader")
+    leader = threading.Thread(target=cache.get_or_generate, args=("slow", 1, lambda warn: release.wait(5) and response([digest])))
+    leader.start()
+    time.sleep(0.05)
+    threading.Timer(0.1, cancel.set).start()
+    start = time.monotonic()
+    success, result = cache.get_or_generate("slow", 1, lambda warn: response([digest]), cancel_event=cancel)
+    assert not success and time.monotonic() - start < 2
+    release.set()
+    leader.join()
+
+
+def test_followers_do_not_inherit_a_cancelled_leaders_partial_result():
+    cache, started, leader_cancel = app.GenerationCache(ttl=60, max_entries=8), threading.Event(), threading.Event()
+    digests = [app.get_image_store().put(f"shared-{i}".encode()) for i in range(2)]
+
+    def cancelled_leader(warn):
+        started.set()
+        leader_cancel.wait(5)
+        warn("第 2 張圖片已取消")
+        return response(digests[:1])
+
+    leader = threading.Thread(target=cache.get_or_generate, args=("shared", 2, cancelled_leader), kwargs={"cancel_event": leader_cancel})
+    leader.start()
+    started.wait(5)
+    follower_warnings, results = [], []
+    follower = threading.Thread(target=lambda: results.append(cache.get_or_generate("shared", 2, lambda warn: warn("follower ran") or response(digests), warn=follower_warnings.append)))
+    follower.start()
+    time.sleep(0.1)
+    leader_cancel.set()
+    leader.join(); follower.join()
+    success, result = results[0]
+    assert success and [img.digest for img in result.data] == digests
+    assert follower_warnings == ["follower ran"]
+
+
+def test_followers_receive_the_leaders_warnings():
+    cache, release = app.GenerationCache(ttl=60, max_entries=8), threading.Event()
+    digest = app.get_image_store().put(b"warned")
+
+    def leader_generate(warn):
+        warn("第 1 張圖片重試後成功")
+        release.wait(5)
+        return response([digest])
+
+    leader = threading.Thread(target=cache.get_or_generate, args=("warned", 1, leader_generate))
+    leader.start()
+    time.sleep(0.05)
+    follower_warnings = []
+    threading.Timer(0.1, release.set).start()
+    success, _ = cache.get_or_generate("warned", 1, lambda warn: response([digest]), warn=follower_warnings.append)
+    leader.join()
+    assert success and follower_warnings == ["第 1 張圖片重試後成功"]
@@ -0,0 +1,60 @@
+import sqlite3
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = app.HistoryDB(str(tmp_path / "history.sqlite3"))
+    db.add_history("u", "一隻貓在日落下飛翔，電影感", "模糊", "flux", ["a"], {})
+    db.add_history("u", "a dog on the beach", "cat, blurry", "flux", ["b"], {})
+    db.add_history("u", "100% cotton_shirt", "", "turbo", ["c"], {})
+    db.add_history("other", "一隻貓", "", "flux", ["d"], {})
+    return db
+
+
+def prompts(db, search, **kwargs):
+    return [item["prompt"] for item in db.history_page("u", 10, search=search, **kwargs)[0]]
+
+
+@pytest.mark.parametrize("search", ["貓", "日落", "日落下飛翔", "電影感 貓"])
+def test_chinese_substrings_match(db, search):
+    assert prompts(db, search) == ["一隻貓在日落下飛翔，電影感"]
+
+
+def test_search_ignores_negative_prompt(db):
+    assert prompts(db, "cat") == []
+    assert prompts(db, "blurry") == [] and prompts(db, "模糊") == []
+
+
+def test_short_and_long_terms_use_the_same_substring_semantics(db):
+    assert prompts(db, "DOG") == prompts(db, "do") == ["a dog on the beach"]
+
+
+def test_like_wildcards_are_escaped(db):
+    assert prompts(db, "%") == ["100% cotton_shirt"]
+    assert prompts(db, "n_s") == ["100% cotton_shirt"]
+    assert prompts(db, "_") == ["100% cotton_shirt"]
+
+
+def test_legacy_fts_index_is_replaced(tmp_path):
+    path = str(tmp_path / "legacy.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE history (id TEXT PRIMARY KEY, user_id TEXT NOT NULL, created_at REAL NOT NULL, model TEXT, prompt TEXT, negative_prompt TEXT, images TEXT, metadata TEXT);
+        CREATE VIRTUAL TABLE history_fts USING fts5(prompt, negative_prompt, content='history', content_rowid='rowid');
+        INSERT INTO history VALUES ('1', 'u', 1.0, 'flux', '一隻貓在日落下飛翔', '', '[]', '{}');
+    """)
+    conn.close()
+    db = app.HistoryDB(path)
+    assert prompts(db, "日落") == ["一隻貓在日落下飛翔"]
+    assert not db._query("SELECT 1 FROM sqlite_master WHERE name = 'history_fts'")
+
+
+def test_cursor_pagination_is_stable(db):
+    first, cursor = db.history_page("u", 2)
+    second, end = db.history_page("u", 2, cursor)
+    assert len(first) == 2 and len(second) == 1 and end is None
+    assert {item["id"] for item in first}.isdisjoint(item["id"] for item in second)
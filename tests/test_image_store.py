@@ -0,0 +1,56 @@
+import os
+import random
+from io import BytesIO
+
+from PIL import Image
+
+import app
+
+
+def png(seed: int, size: int = 64) -> bytes:
+    buffer = BytesIO()
+    Image.frombytes("RGB", (size, size), random.Random(seed).randbytes(size * size * 3)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_lru_eviction_skips_pinned_images(tmp_path):
+    images = [png(i) for i in range(3)]
+    store = app.ImageStore(str(tmp_path), max_bytes=len(images[0]) + len(images[1]) + 10)
+    first = store.put(images[0])
+    store.retain(first)
+    second = store.put(images[1])
+    third = store.put(images[2])
+    assert store.contains(first) and store.contains(third) and not store.contains(second)
+    store.release(first)
+    fourth = store.put(images[1])
+    assert not store.contains(first) and store.contains(third) and store.contains(fourth)
+
+
+def test_new_image_survives_when_pinned_images_fill_the_budget(tmp_path):
+    store = app.ImageStore(str(tmp_path), max_bytes=1000)
+    for i in range(3): store.retain(store.put(png(i)))
+    digest = store.put(png(99))
+    assert store.contains(digest) and store.read(digest) == png(99)
+
+
+def test_thumbnails_count_against_the_budget(tmp_path):
+    store = app.ImageStore(str(tmp_path), max_bytes=10 ** 9)
+    digest = store.put(png(1, 512))
+    before = store.total_bytes
+    thumb = store.read_thumbnail(digest)
+    assert store.total_bytes == before + len(thumb)
+    assert app.ImageStore(str(tmp_path), max_bytes=10 ** 9).total_bytes == store.total_bytes  # 重啟後重新計算
+    store.max_bytes = 0
+    other = store.put(png(2, 512))
+    assert not store.contains(digest) and not os.path.exists(store.thumb_path(digest)) and store.contains(other)
+
+
+def test_thumbnail_hits_refresh_lru_order(tmp_path):
+    store = app.ImageStore(str(tmp_path), max_bytes=10 ** 9)
+    first, second = store.put(png(1)), store.put(png(2))
+    store.read_thumbnail(first)
+    store.read_thumbnail(second)
+    store.read_thumbnail(first)  # 縮圖命中
+    assert list(store._entries) == [second, first]
+    with store._lock: store._remove_locked(first)
+    assert store.read_thumbnail(first) is None
@@ -0,0 +1,45 @@
+import socket
+import urllib.request
+
+import pytest
+import streamlit as st
+
+import app
+
+
+@pytest.fixture
+def fresh_exporters(monkeypatch):
+    monkeypatch.setattr(app._metrics_exporters, "started", None)
+    monkeypatch.setattr(app._metrics_exporters, "errors", {})
+    monkeypatch.setattr(app, "METRICS_FILE", "")
+
+
+def test_port_in_use_is_reported_instead_of_raised(fresh_exporters, monkeypatch):
+    with socket.socket() as busy:
+        busy.bind(("127.0.0.1", 0))
+        busy.listen()
+        monkeypatch.setattr(app, "METRICS_PORT", busy.getsockname()[1])
+        started, errors = app.start_metrics_exporters()
+    assert "http" not in started and "http" in errors
+
+
+def test_exporter_survives_cache_clear(fresh_exporters, monkeypatch):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    monkeypatch.setattr(app, "METRICS_PORT", port)
+    started, errors = app.start_metrics_exporters()
+    st.cache_resource.clear()
+    assert app.start_metrics_exporters() == (started, errors) and not errors
+    body = urllib.request.urlopen(started["http"]).read().decode()
+    assert "# TYPE flux_process_rss_bytes gauge" in body
+    app._metrics_exporters.http_server.shutdown()
+    app._metrics_exporters.http_server.server_close()
+
+
+def test_histogram_renders_cumulative_buckets():
+    metrics = app.MetricsRegistry({"latency": ("histogram", "test", (0.1, 1.0))})
+    for value in (0.05, 0.5, 5): metrics.observe("latency", value, op="x")
+    text = metrics.render()
+    assert 'latency_bucket{op="x",le="0.1"} 1' in text and 'latency_bucket{op="x",le="1.0"} 2' in text
+    assert 'latency_bucket{op="x",le="+Inf"} 3' in text and 'latency_count{op="x"} 3' in text
@@ -0,0 +1,31 @@
+import time
+
+import app
+
+
+def entry(models: dict, version: int) -> dict:
+    return {"models": models, "etag": None, "fetched_at": time.time(), "next_refresh": time.monotonic() + 600, "version": version, "error": None}
+
+
+def test_refresh_between_reads_does_not_memoize_stale_models():
+    registry, key = app.ModelRegistry(ttl=600), ("OpenAI Compatible", "http://registry/v1")
+    old, new = entry({"old-model": {}}, 1), entry({"new-model": {}}, 2)
+    registry._entries[key] = old
+    real_entry = registry._entry
+
+    def entry_then_refresh(*args):
+        snapshot = real_entry(*args)
+        registry._entries[key] = new  # 背景刷新恰好在讀取快照之後完成
+        return snapshot
+
+    registry._entry = entry_then_refresh
+    assert "old-model" in registry.merged(*key, client=None)
+    registry._entry = real_entry
+    merged = registry.merged(*key, client=None)
+    assert "new-model" in merged and "old-model" not in merged
+
+
+def test_merged_is_memoized_per_version():
+    registry, key = app.ModelRegistry(ttl=600), ("OpenAI Compatible", "http://registry-memo/v1")
+    registry._entries[key] = entry({"m": {}}, 1)
+    assert registry.merged(*key, client=None) is registry.merged(*key, client=None)
@@ -0,0 +1,97 @@
+import itertools
+import time
+
+import pytest
+
+import app
+
+_profiles = itertools.count()
+
+
+def profile() -> dict:
+    """每個測試使用獨立的存檔，避免共用熔斷器與排程器。"""
+    return {'provider': 'OpenAI Compatible', 'api_key': 'sk-test', 'base_url': f"http://resilience-{next(_profiles)}/v1"}
+
+
+def open_breaker(cfg: dict) -> app.CircuitBreaker:
+    breaker = app.get_resilience_registry().breaker(cfg)
+    for _ in range(app.CIRCUIT_FAILURE_THRESHOLD): breaker.record_failure()
+    breaker.opened_at -= app.CIRCUIT_RESET_SECONDS  # 跳過冷卻，下一個請求成為試探請求
+    return breaker
+
+
+def failing(error: app.UpstreamError):
+    def fn(): raise error
+    return fn
+
+
+def test_breaker_opens_after_threshold_and_rejects_calls():
+    breaker = app.CircuitBreaker(failure_threshold=2, reset_seconds=60)
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.is_open()
+    with pytest.raises(app.CircuitOpenError): breaker.before_call()
+
+
+def test_half_open_allows_a_single_probe():
+    breaker = app.CircuitBreaker(failure_threshold=1, reset_seconds=0)
+    breaker.record_failure()
+    breaker.before_call()
+    assert breaker.state == "half_open" and breaker.is_open()
+    with pytest.raises(app.CircuitOpenError): breaker.before_call()
+
+
+@pytest.mark.parametrize("error, state", [
+    (app.UpstreamError("HTTP 503", 503), "open"),
+    (app.UpstreamError("HTTP 400", 400, retryable=False), "closed"),
+    (app.UpstreamError("返回的不是圖像 (text/html)", retryable=False), "open"),
+    (app.ImageRejectedError("圖像大小超出上限 25.0 MB"), "closed"),
+    (app.ImageRejectedError("無法識別的圖像數據"), "closed"),
+])
+def test_finished_probe_leaves_half_open(error, state):
+    cfg = profile()
+    breaker = open_breaker(cfg)
+    with pytest.raises(app.UpstreamError): app.call_with_resilience(cfg, failing(error))
+    assert breaker.state == state
+
+
+def test_successful_probe_closes_breaker():
+    cfg = profile()
+    breaker = open_breaker(cfg)
+    assert app.call_with_resilience(cfg, lambda: "ok") == "ok"
+    assert breaker.state == "closed" and breaker.failures == 0
+
+
+def test_cancelled_probe_frees_the_half_open_slot():
+    cfg = profile()
+    breaker = open_breaker(cfg)
+    with pytest.raises(app.RequestCancelledError): app.call_with_resilience(cfg, failing(app.RequestCancelledError("已超出批次時限")))
+    assert not breaker.is_open()
+    assert app.call_with_resilience(cfg, lambda: "ok") == "ok"
+
+
+def test_retry_after_longer_than_max_delay_fails_fast():
+    calls = []
+    def fn():
+        calls.append(1)
+        raise app.UpstreamError("HTTP 429", 429, retry_after=3600)
+    start = time.monotonic()
+    with pytest.raises(app.UpstreamError): app.call_with_resilience(profile(), fn)
+    assert calls == [1] and time.monotonic() - start < 1
+
+
+def test_retry_budget_limits_retries():
+    budget = app.RetryBudget(ratio=0.5, max_tokens=1)
+    assert budget.withdraw() and not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_oversized_images_do_not_open_the_breaker():
+    cfg = profile()
+    for _ in range(app.CIRCUIT_FAILURE_THRESHOLD + 1):
+        with pytest.raises(app.ImageRejectedError): app.call_with_resilience(cfg, failing(app.ImageRejectedError("圖像尺寸 8192x8192 超出上限 4096")))
+    assert not app.get_resilience_registry().breaker(cfg).is_open()
@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def run_waiters(scheduler, priorities, hold=0.02):
+    """按順序排隊，返回實際獲得名額的順序與時間。"""
+    order, lock = [], threading.Lock()
+
+    def worker(name, priority):
+        with scheduler.slot(priority, tag=name):
+            with lock: order.append(name)
+            time.sleep(hold)
+
+    threads = []
+    for name, priority in priorities:
+        threads.append(threading.Thread(target=worker, args=(name, priority)))
+        threads[-1].start()
+        time.sleep(0.02)
+    for t in threads: t.join()
+    return order
+
+
+def test_interactive_requests_jump_ahead_of_queued_batches():
+    scheduler = app.ProfileScheduler(rate_per_minute=600, burst=1, max_concurrency=1)
+    order = run_waiters(scheduler, [("b0", app.PRIORITY_BATCH), ("b1", app.PRIORITY_BATCH), ("b2", app.PRIORITY_BATCH), ("i0", app.PRIORITY_INTERACTIVE)])
+    assert order[0] == "b0" and order.index("i0") < order.index("b2")
+
+
+def test_aged_batches_are_promoted(monkeypatch):
+    monkeypatch.setattr(app, "SCHEDULER_AGING_SECONDS", 0.05)
+    scheduler = app.ProfileScheduler(rate_per_minute=6000, burst=1, max_concurrency=1)
+    now = time.monotonic()
+    scheduler._waiters = [{"priority": app.PRIORITY_BATCH, "seq": 1, "enqueued": now - 0.2, "tag": "old-batch"}, {"priority": app.PRIORITY_INTERACTIVE, "seq": 2, "enqueued": now, "tag": "new"}]
+    assert scheduler._ordered_locked(now)[0]["tag"] == "old-batch"
+
+
+def test_token_bucket_limits_rate_after_burst():
+    scheduler = app.ProfileScheduler(rate_per_minute=600, burst=2, max_concurrency=10)  # 10/s
+    start = time.monotonic()
+    for _ in range(4): scheduler.release(scheduler.acquire(app.PRIORITY_BATCH))
+    assert 0.15 <= time.monotonic() - start < 1
+
+
+def test_concurrency_cap_and_status():
+    scheduler = app.ProfileScheduler(rate_per_minute=6000, burst=10, max_concurrency=1)
+    scheduler.acquire(app.PRIORITY_BATCH)
+    waiter = threading.Thread(target=lambda: scheduler.release(scheduler.acquire(app.PRIORITY_BATCH, tag="job")))
+    waiter.start()
+    time.sleep(0.05)
+    status = scheduler.status("job")
+    assert status["active"] == 1 and status["waiting"] == 1 and status["position"] == 0
+    scheduler.release(0.1)
+    waiter.join(1)
+    assert not waiter.is_alive() and scheduler.status()["active"] == 0
+
+
+def test_throttle_pauses_all_requests():
+    scheduler = app.ProfileScheduler(rate_per_minute=6000, burst=10, max_concurrency=10)
+    scheduler.throttle(0.3)
+    start = time.monotonic()
+    scheduler.release(scheduler.acquire(app.PRIORITY_INTERACTIVE))
+    assert time.monotonic() - start >= 0.28
+
+
+def test_pause_beyond_deadline_fails_fast_and_is_capped():
+    scheduler = app.ProfileScheduler(rate_per_minute=6000, burst=10, max_concurrency=10)
+    scheduler.throttle(3600, max_pause=0.2)
+    start = time.monotonic()
+    with pytest.raises(app.RequestCancelledError): scheduler.acquire(app.PRIORITY_BATCH, deadline=start + 0.15)
+    assert time.monotonic() - start < 0.05  # 暫停超出時限時立即失敗，不空等
+    scheduler.release(scheduler.acquire(app.PRIORITY_BATCH, deadline=start + 5))
+    assert time.monotonic() - start < 1  # 暫停被限制在 max_pause 內
+
+
+def test_cancel_and_deadline_leave_the_queue():
+    scheduler = app.ProfileScheduler(rate_per_minute=6000, burst=1, max_concurrency=1)
+    scheduler.acquire(app.PRIORITY_BATCH)
+    cancelled = threading.Event()
+    cancelled.set()
+    with pytest.raises(app.RequestCancelledError): scheduler.acquire(app.PRIORITY_BATCH, cancelled=cancelled)
+    with pytest.raises(app.RequestCancelledError): scheduler.acquire(app.PRIORITY_BATCH, deadline=time.monotonic() + 0.05)
+    assert scheduler.status()["waiting"] == 0
+
+
+def test_profiles_share_a_scheduler_per_credentials():
+    registry = app.RequestScheduler(app.PROVIDER_RATE_LIMITS)
+    cfg = {'provider': 'Pollinations.ai', 'base_url': 'http://p', 'pollinations_auth_mode': '免費'}
+    assert registry.get(cfg) is registry.get({**cfg, 'validated': True})
+    assert registry.get({**cfg, 'max_concurrency': 2}).max_concurrency == 2  # 修改後的存檔設定立即生效
+    assert registry.get(cfg).max_concurrency == 2  # 不帶覆蓋值的舊副本不會把限速改回預設